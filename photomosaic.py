@@ -7,12 +7,130 @@
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import itertools
+import json
+import multiprocessing
 import os
+import socketserver
+import sqlite3
+import sys
+import time
+import tracemalloc
 
 import numpy as np
 from PIL import Image
 
+try:
+    # k-d 树索引依赖 scipy，没有安装时退回到 numpy 批量匹配
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
+
+class Stats:
+    """
+    运行统计：分阶段的计时器和计数器
+
+    同名阶段的耗时和调用次数累加。开启 tracemalloc 时还会记录每个阶段新分配内存的峰值；嵌套
+    的阶段会把峰值同时计入外层阶段。只统计当前进程，进程池里的工作进程不计入。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        # 正在执行的阶段，每项为 [开始时的内存, 阶段内的内存峰值]
+        self.stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        统计一个阶段的耗时，用法：with STATS.stage('match'): ...
+
+        @param {str} name 阶段名称
+        """
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+            self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += time.perf_counter() - start
+            entry['calls'] += 1
+            if tracing:
+                self.stack.pop()
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                entry['allocated_bytes'] = max(
+                    entry.get('allocated_bytes', 0), peak - frame[0])
+                if self.stack:
+                    self.stack[-1][1] = max(self.stack[-1][1], peak)
+
+    def timed(self, name):
+        """
+        函数装饰器，把整个函数作为一个阶段统计
+
+        @param {str} name 阶段名称
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """
+        累加计数器
+
+        @param {str} name 计数器名称
+        @param {int} n 增加的数量
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def toDict(self):
+        """
+        @return {dict} 可以直接序列化为 JSON 的统计结果
+        """
+
+        rates = {}
+        match = self.stages.get('match')
+        if match and match['seconds'] > 0:
+            rates['cells_matched_per_second'] = (
+                self.counters.get('cells_matched', 0) / match['seconds'])
+        load = self.stages.get('load_tiles')
+        if load and load['seconds'] > 0:
+            rates['images_decoded_per_second'] = (
+                self.counters.get('images_decoded', 0) / load['seconds'])
+        return {
+            'stages': self.stages,
+            'counters': self.counters,
+            'rates': rates,
+            'peak_rss': getPeakRSS(),
+        }
+
+
+# 全局运行统计
+STATS = Stats()
+
+
+@STATS.timed('split')
 def splitImage(image, size):
     """
     将图像按网格划分成多个小图像
@@ -34,6 +152,380 @@ def splitImage(image, size):
     return imgs
 
 
+def getGridAverages(image, size):
+    """
+    将图像按网格划分，一次算出所有网格的平均 RGB 值
+
+    图像只转换一次为 numpy 数组，再通过 reshape 得到形状为 (m, h, n, w, 3) 的视图，不会为每个
+    网格创建 Image 对象或复制数据。网格划分方式和取整方式与 splitImage、getAverageRGB 完全
+    一致，和 scan 一样忽略透明通道，各个后端对带透明通道的目标图像也得到相同的结果。
+
+    @param {Image} image PIL Image 对象
+    @param {Tuple[int, int]} size 网格的行数和列数
+    @return {np.ndarray} 形状为 (m, n, 3) 的 int64 数组
+    """
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    W, H = image.size[0], image.size[1]
+    m, n = size
+    w, h = int(W / n), int(H / m)
+    pixels = np.asarray(image)
+    # 丢掉除不尽的右边和下边，切分坐标轴得到的仍是原数组的视图
+    cells = pixels[:m * h, :n * w].reshape(m, h, n, w, 3)
+    sums = cells.sum(axis=(1, 3), dtype=np.int64)
+    return sums // (w * h)
+
+
+# sRGB（D65 白点）线性值到 CIE XYZ 的转换矩阵
+RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                       [0.2126729, 0.7151522, 0.0721750],
+                       [0.0193339, 0.1191920, 0.9503041]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgbToLab(rgb):
+    """
+    将 sRGB 颜色值转换为 CIELAB 颜色值
+
+    CIELAB 空间里的欧氏距离更接近人眼感受到的颜色差异，用它来匹配，同样大小的替换图像库
+    可以得到更好的效果。
+
+    @param {np.ndarray} rgb 最后一维为 R、G、B 的数组，取值范围 0 ~ 255
+    @return {np.ndarray} 形状相同的 float32 数组，最后一维为 L、a、b
+    """
+
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    # 去掉 sRGB 的 gamma 校正，得到线性值
+    linear = np.where(rgb <= 0.04045, rgb / 12.92,
+                      ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ RGB_TO_XYZ.T / D65_WHITE
+    delta = 6.0 / 29.0
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz),
+                 xyz / (3 * delta * delta) + 4.0 / 29.0)
+    lab = np.empty(f.shape, dtype=np.float32)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+# 支持的匹配颜色空间
+COLOR_SPACES = ('rgb', 'lab')
+
+
+def getGridFeatures(image, size, color_space='rgb', subgrid=1):
+    """
+    将图像按网格划分，一次算出所有网格的颜色特征
+
+    每个网格再划分为 subgrid * subgrid 个子网格，特征由每个子网格的平均颜色依次排列组成，
+    能够区分颜色平均值相同但分布不同的网格。平均颜色先在 RGB 空间计算，再按需转换为 CIELAB。
+    和 getGridAverages 一样忽略透明通道，替换图像也按同样的方式计算。
+
+    @param {Image} image PIL Image 对象
+    @param {Tuple[int, int]} size 网格的行数和列数
+    @param {str} color_space 颜色空间，rgb 或 lab
+    @param {int} subgrid 每个网格每行、每列划分的子网格个数
+    @return {np.ndarray} 形状为 (m, n, subgrid * subgrid * 3) 的连续 float32 数组
+    """
+
+    if color_space not in COLOR_SPACES:
+        raise ValueError('unknown color space: %s' % (color_space,))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    W, H = image.size[0], image.size[1]
+    m, n = size
+    w, h = int(W / n), int(H / m)
+    sw, sh = int(w / subgrid), int(h / subgrid)
+    if sw == 0 or sh == 0:
+        raise ValueError('cells of %dx%d pixels are too small for a %dx%d '
+                         'subgrid' % (w, h, subgrid, subgrid))
+    pixels = np.asarray(image)
+    # 和 getGridAverages 一样按网格切分，再把每个网格切分成子网格，全部是原数组的视图
+    cells = pixels[:m * h, :n * w].reshape(m, h, n, w, 3)
+    cells = cells[:, :subgrid * sh, :, :subgrid * sw]
+    cells = cells.reshape(m, subgrid, sh, n, subgrid, sw, 3)
+    means = cells.mean(axis=(2, 5))
+    # (m, subgrid, n, subgrid, 3) 调整为 (m, n, subgrid, subgrid, 3)
+    means = means.transpose(0, 2, 1, 3, 4)
+    if color_space == 'lab':
+        means = rgbToLab(means)
+    return np.ascontiguousarray(means.reshape(m, n, -1), dtype=np.float32)
+
+
+@STATS.timed('grid_features')
+def getTargetFeatures(image, size, color_space='rgb', subgrid=1):
+    """
+    计算目标图像每个网格用于匹配的颜色值或特征，按先行后列排列
+
+    默认使用和 getAverageRGB 完全一致的整数平均 RGB 值，否则使用 getGridFeatures 的特征。
+
+    @param {Image} image PIL Image 对象
+    @param {Tuple[int, int]} size 网格的行数和列数
+    @param {str} color_space 颜色空间，rgb 或 lab
+    @param {int} subgrid 每个网格每行、每列划分的子网格个数
+    @return {np.ndarray} 形状为 (m * n, d) 的数组
+    """
+
+    if color_space == 'rgb' and subgrid == 1:
+        return getGridAverages(image, size).reshape(-1, 3)
+    feats = getGridFeatures(image, size, color_space, subgrid)
+    return feats.reshape(-1, feats.shape[-1])
+
+
+def getTileFeatureArray(images, color_space='rgb', subgrid=1):
+    """
+    计算替换图像列表里每个图像的颜色特征
+
+    @param {List[Image]} images PIL Image 对象列表
+    @param {str} color_space 颜色空间，rgb 或 lab
+    @param {int} subgrid 每个图像每行、每列划分的子网格个数
+    @return {np.ndarray} 形状为 (k, subgrid * subgrid * 3) 的连续 float32 数组
+    """
+
+    feats = np.empty((len(images), subgrid * subgrid * 3), dtype=np.float32)
+    for index, img in enumerate(images):
+        feats[index] = getGridFeatures(img, (1, 1), color_space, subgrid)[0, 0]
+    return feats
+
+
+# 带透明通道的图像模式，转换为 RGBA 后按 alpha 加权计算平均颜色
+ALPHA_MODES = ('RGBA', 'RGBa', 'LA', 'La', 'PA')
+
+
+def getRGBAlphaArrays(image):
+    """
+    将任意模式的图像转换为 RGB 数组和 alpha 数组
+
+    灰度、调色板等图像转换为 RGB；带透明通道（包括带 transparency 的调色板图像）的图像
+    额外返回 alpha 通道，用作计算平均颜色时每个像素的权重，完全透明的像素不参与平均。
+
+    @param {Image} image PIL Image 对象
+    @return {Tuple[np.ndarray, Optional[np.ndarray]]} (H, W, 3) 的 uint8 RGB 数组和
+        (H, W) 的 uint8 alpha 数组，没有透明通道时 alpha 数组为 None
+    """
+
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode in ALPHA_MODES:
+        pixels = np.asarray(image.convert('RGBA'))
+        return pixels[..., :3], pixels[..., 3]
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image), None
+
+
+class IntegralImage(object):
+    """
+    图像的积分图（summed-area table）
+
+    积分图在每个位置保存它左上方所有像素之和，任意矩形区域之和只需要查四个角，是 O(1) 的，
+    和区域大小无关。对同一个目标图像计算均匀网格、四叉树网格或者互相重叠的网格时，只需要
+    遍历一次像素。带透明通道的图像保存按 alpha 加权的和以及 alpha 之和，只有自适应网格使用它，
+    均匀网格的 getGridAverages、getGridFeatures 和 scan 一样忽略透明通道。
+
+    每个通道用 int64 累加，结果是精确的整数，每个像素约占 24 字节（sum_squares 时 48 字节）。
+    """
+
+    def __init__(self, image, squares=False):
+        """
+        @param {Image} image PIL Image 对象，任意模式
+        @param {bool} squares 是否同时计算平方和的积分图，计算方差时需要
+        """
+
+        rgb, alpha = getRGBAlphaArrays(image)
+        self.height, self.width = rgb.shape[0], rgb.shape[1]
+        values = rgb.astype(np.int64)
+        if alpha is None:
+            self.weights = None
+        else:
+            weights = alpha.astype(np.int64)
+            self.weights = self.integrate(weights)
+            values *= weights[..., None]
+        self.sums = self.integrate(values)
+        self.squares = None
+        if squares:
+            squared = rgb.astype(np.int64)
+            squared *= squared
+            if alpha is not None:
+                squared *= weights[..., None]
+            self.squares = self.integrate(squared)
+
+    @staticmethod
+    def integrate(values):
+        """
+        计算数组前两维的积分表，第一行和第一列补 0，省去边界判断
+
+        @param {np.ndarray} values 形状为 (H, W, ...) 的数组
+        @return {np.ndarray} 形状为 (H + 1, W + 1, ...) 的 int64 数组
+        """
+
+        H, W = values.shape[0], values.shape[1]
+        table = np.zeros((H + 1, W + 1) + values.shape[2:], dtype=np.int64)
+        np.cumsum(values, axis=0, dtype=np.int64, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+    @staticmethod
+    def getBoxSums(table, boxes):
+        """
+        用积分表计算一组矩形区域之和
+
+        @param {np.ndarray} table integrate 返回的积分表
+        @param {np.ndarray} boxes 形状为 (k, 4) 的整数数组，每行为 (x0, y0, x1, y1)，
+            不包含 x1 列和 y1 行
+        @return {np.ndarray} 每个矩形区域之和，形状为 (k, ...)
+        """
+
+        x0, y0, x1, y1 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def getWeights(self, boxes):
+        """
+        @param {np.ndarray} boxes 形状为 (k, 4) 的矩形区域
+        @return {np.ndarray} 每个区域的像素个数，带透明通道时为 alpha 之和
+        """
+
+        if self.weights is None:
+            return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        return self.getBoxSums(self.weights, boxes)
+
+    def getSums(self, boxes):
+        """
+        @param {np.ndarray} boxes 形状为 (k, 4) 的矩形区域
+        @return {Tuple[np.ndarray, np.ndarray]} 每个区域 (k, 3) 的 RGB 之和和 (k,) 的权重
+        """
+
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        return self.getBoxSums(self.sums, boxes), self.getWeights(boxes)
+
+    def getAverages(self, boxes):
+        """
+        计算一组矩形区域的平均 RGB 值，完全透明的区域为 0
+
+        @param {np.ndarray} boxes 形状为 (k, 4) 的矩形区域
+        @return {np.ndarray} 形状为 (k, 3) 的 float64 数组
+        """
+
+        sums, weights = self.getSums(boxes)
+        return sums / np.maximum(weights, 1)[:, None]
+
+    def getVariances(self, boxes):
+        """
+        计算一组矩形区域每个通道的颜色方差，需要以 squares=True 创建
+
+        @param {np.ndarray} boxes 形状为 (k, 4) 的矩形区域
+        @return {np.ndarray} 形状为 (k, 3) 的 float64 数组
+        """
+
+        if self.squares is None:
+            raise ValueError('integral image was built without squares')
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        sums, weights = self.getSums(boxes)
+        weights = np.maximum(weights, 1)[:, None]
+        means = sums / weights
+        squares = self.getBoxSums(self.squares, boxes) / weights
+        # E[x^2] - E[x]^2 在舍入误差下可能略小于 0
+        return np.maximum(squares - means * means, 0.0)
+
+
+def getGridBoxes(rows, cols, w, h):
+    """
+    生成按网格排列的矩形区域
+
+    @param {np.ndarray} rows 网格的行号
+    @param {np.ndarray} cols 网格的列号，和 rows 一一对应
+    @param {int} w 网格的宽度
+    @param {int} h 网格的高度
+    @return {np.ndarray} 形状为 (k, 4) 的矩形区域，每行为 (x0, y0, x1, y1)
+    """
+
+    x0 = np.asarray(cols, dtype=np.intp) * w
+    y0 = np.asarray(rows, dtype=np.intp) * h
+    return np.stack([x0, y0, x0 + w, y0 + h], axis=1)
+
+
+def getBoxFeatures(integral, boxes, color_space='rgb', subgrid=1):
+    """
+    用积分图计算一组矩形区域的颜色特征，和 getGridFeatures 的特征一一对应
+
+    @param {IntegralImage} integral 目标图像的积分图
+    @param {np.ndarray} boxes 形状为 (k, 4) 的矩形区域，大小可以各不相同
+    @param {str} color_space 颜色空间，rgb 或 lab
+    @param {int} subgrid 每个区域每行、每列划分的子区域个数
+    @return {np.ndarray} 形状为 (k, subgrid * subgrid * 3) 的连续 float32 数组
+    """
+
+    if color_space not in COLOR_SPACES:
+        raise ValueError('unknown color space: %s' % (color_space,))
+    boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+    sw = (boxes[:, 2] - boxes[:, 0]) // subgrid
+    sh = (boxes[:, 3] - boxes[:, 1]) // subgrid
+    if len(boxes) and (sw.min() == 0 or sh.min() == 0):
+        raise ValueError('boxes are too small for a %dx%d subgrid' %
+                         (subgrid, subgrid))
+    # 每个区域的子区域按先行后列排列，形状为 (k, subgrid, subgrid, 4)
+    j = np.arange(subgrid)
+    x0 = boxes[:, None, None, 0] + j[None, None, :] * sw[:, None, None]
+    y0 = boxes[:, None, None, 1] + j[None, :, None] * sh[:, None, None]
+    x0, y0 = np.broadcast_arrays(x0, y0)
+    sub = np.stack([x0, y0, x0 + sw[:, None, None], y0 + sh[:, None, None]],
+                   axis=-1)
+    means = integral.getAverages(sub.reshape(-1, 4))
+    if color_space == 'lab':
+        means = rgbToLab(means)
+    return np.ascontiguousarray(means.reshape(len(boxes), -1),
+                                dtype=np.float32)
+
+
+def splitQuadtree(image, size, max_depth=2, threshold=20.0, integral=None):
+    """
+    按颜色变化程度自适应地划分网格（四叉树）
+
+    先按 size 划分为均匀网格，颜色标准差超过 threshold 的网格再一分为四，直到 max_depth 层。
+    颜色平坦的区域用大网格，细节多的区域用小网格，用少得多的网格达到和均匀细网格相近的效果。
+    为了让每层的网格大小一致，网格的宽高会裁剪为 2^max_depth 的倍数。每个网格的方差都通过
+    积分图 O(1) 算出，每层只需要计算还在细分的网格。
+
+    @param {Image} image PIL Image 对象
+    @param {Tuple[int, int]} size 第 0 层网格的行数和列数
+    @param {int} max_depth 最多细分的层数
+    @param {float} threshold 继续细分的颜色标准差阈值
+    @param {IntegralImage} integral 已经计算好的带平方和的积分图，为 None 时重新计算
+    @return {Tuple[List[Tuple[np.ndarray, np.ndarray]], Tuple[int, int]]} 每一层作为叶子
+        的网格的行号和列号（按该层的网格计），以及第 0 层网格的宽度和高度
+    """
+
+    W, H = image.size[0], image.size[1]
+    m, n = size
+    unit = 1 << max_depth
+    w, h = int(W / n) // unit * unit, int(H / m) // unit * unit
+    if w == 0 or h == 0:
+        raise ValueError('cells of %dx%d pixels are too small for depth %d' %
+                         (int(W / n), int(H / m), max_depth))
+    if integral is None:
+        integral = IntegralImage(image, squares=True)
+
+    levels = []
+    rows, cols = np.nonzero(np.ones((m, n), dtype=bool))
+    for depth in range(max_depth + 1):
+        if depth == max_depth or len(rows) == 0:
+            subdivide = np.zeros(len(rows), dtype=bool)
+        else:
+            boxes = getGridBoxes(rows, cols, w >> depth, h >> depth)
+            # 三个通道方差的平均值作为网格的颜色变化程度
+            var = integral.getVariances(boxes).mean(axis=-1)
+            subdivide = var > threshold * threshold
+        levels.append((rows[~subdivide], cols[~subdivide]))
+        # 细分的网格在下一层对应 2 x 2 个子网格，保持先行后列的顺序
+        rows, cols = rows[subdivide], cols[subdivide]
+        rows = (rows[:, None] * 2 + np.array([0, 0, 1, 1])).ravel()
+        cols = (cols[:, None] * 2 + np.array([0, 1, 0, 1])).ravel()
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+    return levels, (w, h)
+
+
 def getImages(imageDir):
     """
     从给定目录里加载所有替换图像
@@ -61,6 +553,248 @@ def getImages(imageDir):
     return images
 
 
+def loadTileImage(filePath, dims):
+    """
+    加载单个替换图像，缩放成缩略图并计算平均 RGB 值
+
+    只保留缩略图，原图数据用完即丢弃。
+
+    @param {str} filePath 图像文件路径
+    @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+    @return {Tuple[Image, Tuple[int, int, int]]} 缩略图和平均 RGB 值，图像无效时返回 None
+    """
+
+    try:
+        with open(filePath, "rb") as fp:
+            im = Image.open(fp)
+            # JPEG 可以在解码时直接缩小并输出 RGB，大幅减少解码量；这里和 thumbnail 默认的
+            # reducing_gap 一样保留两倍尺寸，保证缩放质量
+            if im.format == 'JPEG':
+                im.draft('RGB', (dims[0] * 2, dims[1] * 2))
+            im.thumbnail(dims)
+            im = im.convert('RGB')
+    except Exception:
+        return None
+    return im, getAverageRGB(im)
+
+
+class TileCache:
+    """
+    替换图像特征的持久化缓存
+
+    用 SQLite 保存每个替换图像的缩略图和平均 RGB 值，以文件路径和缩略图尺寸为键，并记录文件的
+    修改时间和大小。文件被修改后缓存自动失效，重新计算后覆盖旧记录；无效图像也会记录下来，下次直接
+    跳过。
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tiles ('
+            'path TEXT NOT NULL, width INTEGER NOT NULL, '
+            'height INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, thumb_w INTEGER, thumb_h INTEGER, '
+            'thumb BLOB, avg BLOB, '
+            'PRIMARY KEY (path, width, height))')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filePath, dims, stat):
+        """
+        查询缓存
+
+        @param {str} filePath 图像文件路径
+        @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+        @param {os.stat_result} stat 文件当前的状态信息
+        @return {Tuple[bool, Tuple]} 是否命中，以及命中时的 (缩略图, 平均 RGB 值)，无效
+            图像为 None
+        """
+
+        row = self.conn.execute(
+            'SELECT mtime, size, thumb_w, thumb_h, thumb, avg FROM tiles '
+            'WHERE path = ? AND width = ? AND height = ?',
+            (filePath, dims[0], dims[1])).fetchone()
+        if row is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size:
+            self.misses += 1
+            STATS.count('cache_misses')
+            return False, None
+        self.hits += 1
+        STATS.count('cache_hits')
+        if row[4] is None:
+            return True, None
+        thumb = Image.frombytes('RGB', (row[2], row[3]), row[4])
+        avg = tuple(int(x) for x in np.frombuffer(row[5], dtype=np.int64))
+        return True, (thumb, avg)
+
+    def put(self, filePath, dims, stat, tile):
+        """
+        写入缓存，已有的旧记录会被覆盖
+
+        @param {str} filePath 图像文件路径
+        @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+        @param {os.stat_result} stat 文件当前的状态信息
+        @param {Tuple[Image, Tuple[int, int, int]]} tile 缩略图和平均 RGB 值，无效图像为
+            None
+        """
+
+        if tile is None:
+            thumb_w = thumb_h = thumb = avg = None
+        else:
+            thumb_w, thumb_h = tile[0].size
+            thumb = tile[0].tobytes()
+            avg = np.array(tile[1], dtype=np.int64).tobytes()
+        self.conn.execute(
+            'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (filePath, dims[0], dims[1], stat.st_mtime_ns, stat.st_size,
+             thumb_w, thumb_h, thumb, avg))
+
+    def prune(self, imageDir, dims, filePaths):
+        """
+        删除目录里已经不存在的文件的缓存记录
+
+        @param {str} imageDir 目录路径
+        @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+        @param {Set[str]} filePaths 目录里当前存在的文件路径
+        """
+
+        prefix = os.path.join(os.path.abspath(imageDir), '')
+        rows = self.conn.execute(
+            'SELECT path FROM tiles WHERE width = ? AND height = ? '
+            'AND substr(path, 1, ?) = ?',
+            (dims[0], dims[1], len(prefix), prefix)).fetchall()
+        stale = [(row[0], dims[0], dims[1]) for row in rows
+                 if row[0] not in filePaths]
+        self.conn.executemany(
+            'DELETE FROM tiles WHERE path = ? AND width = ? AND height = ?',
+            stale)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def iterTileLibrary(imageDir, dims, cache=None, workers=1):
+    """
+    逐个加载给定目录里的替换图像，依次生成缩略图及其平均 RGB 值
+
+    这是一个生成器，每次只解码一个文件，缩放后立即丢弃原图，任何时候都不会同时持有多张原尺寸
+    图像。指定 cache 时优先从缓存读取，只有新增或修改过的文件才需要重新解码。workers 大于 1
+    时用进程池并行解码，结果仍按文件顺序依次生成。
+
+    @param {str} imageDir 目录路径
+    @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+    @param {TileCache} cache 替换图像特征缓存，为 None 时不使用缓存
+    @param {int} workers 并行解码的进程数
+    @return {Iterator[Tuple[str, Image, Tuple[int, int, int]]]} 文件路径、缩略图和平均
+        RGB 值
+    """
+
+    # 先查缓存，找出需要重新解码的文件
+    entries = []
+    for file in os.listdir(imageDir):
+        # 得到文件绝对路径
+        filePath = os.path.abspath(os.path.join(imageDir, file))
+        try:
+            stat = os.stat(filePath)
+        except OSError:
+            print("Invalid image: %s" % (filePath,))
+            continue
+        hit, tile = False, None
+        if cache is not None:
+            hit, tile = cache.get(filePath, dims, stat)
+        entries.append((filePath, stat, hit, tile))
+    filePaths = set(entry[0] for entry in entries)
+    misses = [entry[0] for entry in entries if not entry[2]]
+
+    pool = None
+    load = functools.partial(loadTileImage, dims=dims)
+    if workers > 1 and len(misses) > 1:
+        pool = multiprocessing.Pool(workers)
+        # imap 按提交顺序返回结果，解码完一批就处理一批
+        chunksize = max(1, min(64, int(len(misses) / (workers * 4))))
+        results = pool.imap(load, misses, chunksize)
+    else:
+        results = map(load, misses)
+
+    try:
+        for index, (filePath, stat, hit, tile) in enumerate(entries):
+            # 释放对缓存结果的引用，由调用方决定是否保留
+            entries[index] = None
+            if not hit:
+                tile = next(results)
+                STATS.count('images_decoded')
+                if cache is not None:
+                    cache.put(filePath, dims, stat, tile)
+            if tile is None:
+                # 加载某个图像失败，直接跳过
+                print("Invalid image: %s" % (filePath,))
+                STATS.count('images_invalid')
+                continue
+            yield filePath, tile[0], tile[1]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if cache is not None:
+        cache.prune(imageDir, dims, filePaths)
+        print('tile cache: %d hits, %d misses' % (cache.hits, cache.misses))
+
+
+def getPeakRSS():
+    """
+    获取当前进程的内存占用峰值
+
+    @return {int} 峰值字节数，当前平台不支持时返回 None
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上单位是字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@STATS.timed('load_tiles')
+def loadTileLibrary(imageDir, dims, cache=None, workers=1, max_memory=None):
+    """
+    从给定目录里加载所有替换图像的缩略图及其平均 RGB 值
+
+    和 getImages 不同，通过 iterTileLibrary 逐个加载，只保留缩略图。加载结束后打印缩略图
+    占用的内存和进程的内存峰值。
+
+    @param {str} imageDir 目录路径
+    @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+    @param {TileCache} cache 替换图像特征缓存，为 None 时不使用缓存
+    @param {int} workers 并行解码的进程数
+    @param {int} max_memory 缩略图允许占用的最大字节数，超出时抛出 MemoryError，为 None
+        时不限制
+    @return {Tuple[List[Image], np.ndarray]} 缩略图列表和形状为 (k, 3) 的平均 RGB 值数组
+    """
+
+    images = []
+    avgs = []
+    nbytes = 0
+    for _, thumb, avg in iterTileLibrary(imageDir, dims, cache, workers):
+        nbytes += thumb.size[0] * thumb.size[1] * len(thumb.getbands())
+        if max_memory is not None and nbytes > max_memory:
+            raise MemoryError(
+                'tile thumbnails exceed memory limit of %.1f MB after %d '
+                'images' % (max_memory / 1048576.0, len(images)))
+        images.append(thumb)
+        avgs.append(avg)
+
+    peak = getPeakRSS()
+    print('tile library: %d images, %.1f MB thumbnails, peak RSS %s%s' % (
+        len(images), nbytes / 1048576.0,
+        '%.1f MB' % (peak / 1048576.0,) if peak is not None else 'unknown',
+        ' (limit %.1f MB)' % (max_memory / 1048576.0,)
+        if max_memory is not None else ''))
+    return images, np.array(avgs, dtype=np.int64).reshape(-1, 3)
+
+
 def getAverageRGB(image):
     """
     计算图像的平均 RGB 值
@@ -94,12 +828,13 @@ def getAverageRGBNumpy(image):
     @return {Tuple[int, int, int]} 平均 RGB 值
     """
 
-    # 将 PIL Image 对象转换为 numpy 数据数组
-    im = np.array(image)
-    # 获得图像的宽、高和深度
-    w, h, d = im.shape
+    # 将 PIL Image 对象转换为 RGB 数组，灰度、调色板图像转换为 RGB，带透明通道时按 alpha 加权
+    rgb, alpha = getRGBAlphaArrays(image)
+    weights = None if alpha is None else alpha.reshape(-1)
+    if weights is not None and not weights.any():
+        return (0.0, 0.0, 0.0)
     # 将数据数组变形并计算平均值
-    return tuple(np.average(im.reshape(w * h, d), axis=0))
+    return tuple(np.average(rgb.reshape(-1, 3), axis=0, weights=weights))
 
 
 def getBestMatchIndex(input_avg, avgs):
@@ -131,6 +866,382 @@ def getBestMatchIndex(input_avg, avgs):
     return min_index
 
 
+def getAverageRGBArray(images):
+    """
+    计算图像列表里每个图像的平均 RGB 值，结果放到一个 numpy 数组里
+
+    每个元素的计算方式和 getAverageRGB 完全一致（包括取整方式），以保证匹配结果不变。
+
+    @param {List[Image]} images PIL Image 对象列表
+    @return {np.ndarray} 形状为 (k, 3) 的 int64 数组
+    """
+
+    return np.array([getAverageRGB(img) for img in images],
+                    dtype=np.int64).reshape(-1, 3)
+
+
+def getSquaredDistances(input_avgs, avgs, avgs_sq=None):
+    """
+    计算两组颜色值两两之间的平方距离
+
+    展开 |a - b|^2 = |a|^2 - 2ab + |b|^2 做矩阵运算。颜色值是整数时所有中间结果都是小于
+    2^53 的整数，用 float64 计算（可以走 BLAS 矩阵乘法）也不会有舍入误差。
+
+    @param {np.ndarray} input_avgs 形状为 (c, d) 的目标颜色值数组
+    @param {np.ndarray} avgs 形状为 (k, d) 的要搜索的颜色值数组
+    @param {np.ndarray} avgs_sq 预先算好的 avgs 每行的平方和，为 None 时现场计算
+    @return {np.ndarray} 形状为 (c, k) 的平方距离矩阵
+    """
+
+    if avgs_sq is None:
+        avgs_sq = np.einsum('ij,ij->i', avgs, avgs)
+    dist = input_avgs @ avgs.T
+    dist *= -2
+    dist += avgs_sq
+    dist += np.einsum('ij,ij->i', input_avgs, input_avgs)[:, None]
+    return dist
+
+
+def getBestMatchIndices(input_avgs, avgs, chunk_size=None,
+                        max_bytes=64 * 1024 * 1024):
+    """
+    批量找出每个颜色值在 avgs 里最接近的索引
+
+    和 getBestMatchIndex 的结果完全一致：距离同样是整数平方距离，np.argmin 在距离相等时
+    同样返回最靠前的索引。为了控制内存占用，目标颜色按块处理，每块的距离矩阵大小约为
+    chunk_size * len(avgs) 个 float64。
+
+    @param {np.ndarray} input_avgs 形状为 (c, d) 的目标颜色值（或特征）数组
+    @param {np.ndarray} avgs 形状为 (k, d) 的要搜索的颜色值（或特征）数组
+    @param {int} chunk_size 每块处理的目标颜色个数，为 None 时根据 max_bytes 计算
+    @param {int} max_bytes 每块距离矩阵允许占用的最大字节数
+    @return {np.ndarray} 形状为 (c,) 的命中索引数组
+    """
+
+    input_avgs = np.asarray(input_avgs, dtype=np.float64)
+    input_avgs = input_avgs.reshape(len(input_avgs), -1)
+    avgs = np.asarray(avgs, dtype=np.float64)
+    avgs = avgs.reshape(len(avgs), -1)
+    if chunk_size is None:
+        chunk_size = max(1, int(max_bytes / (8 * max(1, len(avgs)))))
+
+    avgs_sq = np.einsum('ij,ij->i', avgs, avgs)
+    indices = np.empty(len(input_avgs), dtype=np.intp)
+    for start in range(0, len(input_avgs), chunk_size):
+        dist = getSquaredDistances(input_avgs[start:start + chunk_size], avgs,
+                                   avgs_sq)
+        indices[start:start + chunk_size] = np.argmin(dist, axis=1)
+    return indices
+
+
+def buildColorIndex(avgs, leafsize=16):
+    """
+    为替换图像的颜色值建立 k-d 树索引
+
+    索引对同一个替换图像库只需建立一次，之后每个网格的查询都是 O(log n) 的。
+
+    @param {np.ndarray} avgs 形状为 (k, d) 的颜色值数组
+    @param {int} leafsize k-d 树叶子节点包含的最大点数
+    @return {cKDTree} k-d 树索引，没有安装 scipy 时返回 None
+    """
+
+    if cKDTree is None:
+        return None
+    avgs = np.asarray(avgs, dtype=np.float64)
+    return cKDTree(avgs.reshape(len(avgs), -1), leafsize=leafsize)
+
+
+def queryColorIndex(index, input_avgs, eps=0.0):
+    """
+    在 k-d 树索引里批量查询最接近的颜色值索引
+
+    eps 为 0 时是精确查找，距离和逐个扫描的结果相同（距离相等时命中的索引可能不同）；eps
+    大于 0 时为近似查找，保证找到的距离不超过真实最近距离的 (1 + eps) 倍，换取更快的查询。
+
+    @param {cKDTree} index buildColorIndex 建立的索引
+    @param {np.ndarray} input_avgs 形状为 (c, d) 的目标颜色值数组
+    @param {float} eps 近似查找允许的相对误差
+    @return {np.ndarray} 形状为 (c,) 的命中索引数组
+    """
+
+    input_avgs = np.asarray(input_avgs, dtype=np.float64)
+    _, indices = index.query(input_avgs.reshape(len(input_avgs), -1),
+                             k=1, eps=eps)
+    return np.asarray(indices, dtype=np.intp)
+
+
+@STATS.timed('match')
+def getMatchIndices(target_avgs, input_avgs, backend='numpy',
+                    color_index=None, eps=0.0):
+    """
+    用指定的批量匹配后端为每个目标颜色值找到最接近的替换图像索引
+
+    @param {np.ndarray} target_avgs 形状为 (c, 3) 的目标颜色值数组
+    @param {np.ndarray} input_avgs 形状为 (k, 3) 的替换图像颜色值数组
+    @param {str} backend 匹配后端，numpy 或 kdtree
+    @param {cKDTree} color_index 预先建立好的 k-d 树索引，为 None 时现场建立
+    @param {float} eps kdtree 后端近似查找允许的相对误差
+    @return {np.ndarray} 形状为 (c,) 的命中索引数组
+    """
+
+    STATS.count('cells_matched', len(target_avgs))
+    if backend == 'kdtree':
+        if color_index is None:
+            color_index = buildColorIndex(input_avgs)
+        if color_index is not None:
+            return queryColorIndex(color_index, target_avgs, eps)
+    return getBestMatchIndices(target_avgs, input_avgs)
+
+
+@STATS.timed('stack_tiles')
+def stackTiles(images):
+    """
+    将替换图像堆叠成一个 (k, h, w, 3) 的 uint8 数组
+
+    h、w 是所有图像的最大高度和宽度，尺寸不足的图像放在左上角，其余部分填充黑色，和
+    createImageGrid 粘贴的效果一致。
+
+    @param {List[Image]} images 替换图像列表
+    @return {Tuple[np.ndarray, np.ndarray]} 图像数组和形状为 (k, 2) 的每个图像的宽高
+    """
+
+    sizes = np.array([img.size for img in images], dtype=np.intp).reshape(-1, 2)
+    width, height = sizes.max(axis=0) if len(images) else (0, 0)
+    atlas = np.zeros((len(images), height, width, 3), dtype=np.uint8)
+    for index, img in enumerate(images):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        w, h = img.size
+        atlas[index, :h, :w] = np.asarray(img)
+    return atlas, sizes
+
+
+def getGridCellSize(atlas, indices, sizes=None):
+    """
+    计算拼接时每个网格的宽度和高度
+
+    和 createImageGrid 一样，取实际用到的图像的最大宽度和高度。
+
+    @param {np.ndarray} atlas stackTiles 得到的 (k, h, w, 3) 图像数组
+    @param {np.ndarray} indices 每个网格使用的图像索引
+    @param {np.ndarray} sizes stackTiles 得到的每个图像的宽高，为 None 时使用 atlas 的
+        完整大小
+    @return {Tuple[int, int]} 网格的宽度和高度
+    """
+
+    if sizes is None:
+        return atlas.shape[2], atlas.shape[1]
+    width, height = sizes[np.asarray(indices).ravel()].max(axis=0)
+    return int(width), int(height)
+
+
+@STATS.timed('assemble')
+def createImageGridArray(atlas, indices, dims, sizes=None):
+    """
+    按索引从图像数组里取出小图像，先行后列拼接为一个大图像
+
+    输出数组预先分配好，每次用花式索引取出一行的小图像直接写入，最后只转换一次为 Image，
+    结果和对相应图像调用 createImageGrid 相同。
+
+    @param {np.ndarray} atlas stackTiles 得到的 (k, h, w, 3) 图像数组
+    @param {np.ndarray} indices 每个网格使用的图像索引，按先行后列的顺序排列
+    @param {Tuple[int, int]} dims 大图像的行数和列数
+    @param {np.ndarray} sizes stackTiles 得到的每个图像的宽高，用来按实际使用的图像计算
+        网格大小，为 None 时使用 atlas 的完整大小
+    @return Image 拼接得到的大图像
+    """
+
+    m, n = dims
+    indices = np.asarray(indices, dtype=np.intp).reshape(m, n)
+    width, height = getGridCellSize(atlas, indices, sizes)
+
+    grid = np.empty((m, height, n, width, 3), dtype=np.uint8)
+    for row in range(m):
+        # (n, h, w, 3) 转置为 (h, n, w, 3) 写入第 row 行
+        grid[row] = atlas[indices[row], :height, :width].transpose(1, 0, 2, 3)
+    STATS.count('output_bytes', grid.nbytes)
+    return Image.fromarray(grid.reshape(m * height, n * width, 3))
+
+
+# writeImageGridStrips 支持的输出格式
+STRIP_FORMATS = ('.ppm', '.raw', '.npy')
+
+
+@STATS.timed('assemble')
+def writeImageGridStrips(atlas, indices, dims, path, sizes=None):
+    """
+    逐行拼接小图像并写入文件，不在内存里创建完整的大图像
+
+    每次只拼接一行网格（一个条带），写完再处理下一行，内存峰值只和一行网格的大小有关，适合
+    生成打印尺寸的超大马赛克图像。根据扩展名选择格式：.ppm 为二进制 PPM（PIL 和常见图像
+    工具都能读取），.raw 为不带文件头的 RGB 数据，.npy 为 numpy 数组文件（通过内存映射写入，
+    可以用 np.load(path, mmap_mode='r') 按需读取）。
+
+    @param {np.ndarray} atlas stackTiles 得到的 (k, h, w, 3) 图像数组
+    @param {np.ndarray} indices 每个网格使用的图像索引，按先行后列的顺序排列
+    @param {Tuple[int, int]} dims 大图像的行数和列数
+    @param {str} path 输出文件路径
+    @param {np.ndarray} sizes stackTiles 得到的每个图像的宽高
+    @return {Tuple[int, int]} 大图像的宽度和高度
+    """
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in STRIP_FORMATS:
+        raise ValueError('unsupported strip format: %s' % (ext,))
+
+    m, n = dims
+    indices = np.asarray(indices, dtype=np.intp).reshape(m, n)
+    width, height = getGridCellSize(atlas, indices, sizes)
+    W, H = n * width, m * height
+
+    # 条带缓冲区只分配一次，每行重复使用
+    strip = np.empty((height, n, width, 3), dtype=np.uint8)
+    if ext == '.npy':
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                        shape=(H, W, 3))
+        for row in range(m):
+            strip[:] = atlas[indices[row], :height, :width].transpose(
+                1, 0, 2, 3)
+            out[row * height:(row + 1) * height] = strip.reshape(height, W, 3)
+            # 及时写回磁盘，让操作系统可以回收已写完的页
+            out.flush()
+        del out
+    else:
+        with open(path, 'wb') as fp:
+            if ext == '.ppm':
+                fp.write(b'P6\n%d %d\n255\n' % (W, H))
+            for row in range(m):
+                strip[:] = atlas[indices[row], :height, :width].transpose(
+                    1, 0, 2, 3)
+                fp.write(strip.data)
+    return W, H
+
+
+# 支持的输出格式及对应的 PIL 格式名
+OUTPUT_FORMATS = {
+    'png': 'PNG',
+    'jpeg': 'JPEG',
+    'webp': 'WEBP',
+    'tiff': 'TIFF',
+    'bmp': 'BMP',
+    'ppm': 'PPM',
+}
+
+# 文件扩展名对应的输出格式
+OUTPUT_EXTENSIONS = {
+    '.png': 'png',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.webp': 'webp',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.bmp': 'bmp',
+    '.ppm': 'ppm',
+}
+
+
+def getOutputFormat(path, fmt=None):
+    """
+    确定输出格式：优先使用指定的格式，否则根据扩展名判断，都无法确定时使用 PNG
+
+    @param {str} path 输出文件路径
+    @param {str} fmt 指定的输出格式
+    @return {str} OUTPUT_FORMATS 里的输出格式
+    """
+
+    if fmt:
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format: %s' % (fmt,))
+        return fmt
+    return OUTPUT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'png')
+
+
+def getSaveOptions(fmt, quality=None, compress_level=None):
+    """
+    生成传给 Image.save 的编码参数
+
+    PNG 的压缩级别 0 ~ 9，越小编码越快、文件越大；JPEG、WebP 使用质量参数；TIFF 不压缩，
+    编码最快。
+
+    @param {str} fmt 输出格式
+    @param {int} quality JPEG、WebP 的质量，1 ~ 100
+    @param {int} compress_level PNG 的压缩级别
+    @return {dict} 编码参数
+    """
+
+    options = {}
+    if fmt == 'png' and compress_level is not None:
+        options['compress_level'] = compress_level
+    elif fmt in ('jpeg', 'webp'):
+        options['quality'] = quality if quality is not None else 90
+    elif fmt == 'tiff':
+        options['compression'] = 'raw'
+    return options
+
+
+@STATS.timed('encode')
+def saveMosaic(image, path, fmt=None, quality=None, compress_level=None):
+    """
+    按指定的格式和编码参数保存马赛克图像
+
+    @param {Image} image 马赛克图像
+    @param {str} path 输出文件路径
+    @param {str} fmt 输出格式，为 None 时根据扩展名判断
+    @param {int} quality JPEG、WebP 的质量
+    @param {int} compress_level PNG 的压缩级别
+    """
+
+    fmt = getOutputFormat(path, fmt)
+    image.save(path, OUTPUT_FORMATS[fmt],
+               **getSaveOptions(fmt, quality, compress_level))
+
+
+@STATS.timed('encode')
+def writeImageGridStripFiles(atlas, indices, dims, path, sizes=None,
+                             rows_per_strip=16, workers=4, fmt=None,
+                             quality=None, compress_level=None):
+    """
+    把马赛克图像按条带拼接并分别编码为多个文件，多个条带并行编码
+
+    每个条带包含 rows_per_strip 行网格，保存为 <文件名>_<序号>.<扩展名>。PIL 编码时会释放
+    GIL，用线程池就能利用多个核，同时最多只有 workers 个条带在内存里。拼接条带和编码在同一个
+    线程里交替进行，耗时主要在编码，统计在 encode 阶段。
+
+    @param {np.ndarray} atlas stackTiles 得到的 (k, h, w, 3) 图像数组
+    @param {np.ndarray} indices 每个网格使用的图像索引，按先行后列的顺序排列
+    @param {Tuple[int, int]} dims 大图像的行数和列数
+    @param {str} path 输出文件路径，实际文件名会加上条带序号
+    @param {np.ndarray} sizes stackTiles 得到的每个图像的宽高
+    @param {int} rows_per_strip 每个条带包含的网格行数
+    @param {int} workers 并行编码的线程数
+    @param {str} fmt 输出格式，为 None 时根据扩展名判断
+    @param {int} quality JPEG、WebP 的质量
+    @param {int} compress_level PNG 的压缩级别
+    @return {List[str]} 条带文件路径列表
+    """
+
+    fmt = getOutputFormat(path, fmt)
+    options = getSaveOptions(fmt, quality, compress_level)
+    stem, ext = os.path.splitext(path)
+    m, n = dims
+    indices = np.asarray(indices, dtype=np.intp).reshape(m, n)
+    width, height = getGridCellSize(atlas, indices, sizes)
+    starts = list(range(0, m, rows_per_strip))
+    paths = ['%s_%04d%s' % (stem, i, ext) for i in range(len(starts))]
+
+    def encode(i):
+        rows = indices[starts[i]:starts[i] + rows_per_strip]
+        # (r, n, h, w, 3) 转置为 (r, h, n, w, 3) 得到条带像素
+        strip = atlas[rows, :height, :width].transpose(0, 2, 1, 3, 4)
+        strip = strip.reshape(len(rows) * height, n * width, 3)
+        Image.fromarray(strip).save(paths[i], OUTPUT_FORMATS[fmt], **options)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        list(executor.map(encode, range(len(starts))))
+    return paths
+
+
+@STATS.timed('assemble')
 def createImageGrid(images, dims):
     """
     将图像列表里的小图像按先行后列的顺序拼接为一个大图像
@@ -164,48 +1275,309 @@ def createImageGrid(images, dims):
     return grid_img
 
 
+def getNearestCandidates(target_avgs, input_avgs, k, color_index=None,
+                         max_bytes=64 * 1024 * 1024):
+    """
+    为每个目标颜色值找出距离最近的 k 个替换图像，按距离从近到远排列
+
+    @param {np.ndarray} target_avgs 形状为 (c, d) 的目标颜色值数组
+    @param {np.ndarray} input_avgs 形状为 (k, d) 的替换图像颜色值数组
+    @param {int} k 每个目标颜色值的候选个数
+    @param {cKDTree} color_index k-d 树索引，为 None 时分块做矩阵运算
+    @param {int} max_bytes 每块距离矩阵允许占用的最大字节数
+    @return {np.ndarray} 形状为 (c, k) 的候选索引数组
+    """
+
+    k = min(k, len(input_avgs))
+    target_avgs = np.asarray(target_avgs, dtype=np.float64)
+    input_avgs = np.asarray(input_avgs, dtype=np.float64)
+    if color_index is not None:
+        _, indices = color_index.query(target_avgs, k=k)
+        return np.asarray(indices, dtype=np.intp).reshape(len(target_avgs), k)
+
+    avgs_sq = np.einsum('ij,ij->i', input_avgs, input_avgs)
+    chunk_size = max(1, int(max_bytes / (8 * max(1, len(input_avgs)))))
+    indices = np.empty((len(target_avgs), k), dtype=np.intp)
+    for start in range(0, len(target_avgs), chunk_size):
+        dist = getSquaredDistances(target_avgs[start:start + chunk_size],
+                                   input_avgs, avgs_sq)
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        # 候选按距离排序，距离相等时索引小的在前
+        order = np.lexsort((part, np.take_along_axis(dist, part, axis=1)))
+        indices[start:start + chunk_size] = np.take_along_axis(part, order,
+                                                               axis=1)
+    return indices
+
+
+# assignTiles 用匈牙利算法时允许的最大代价矩阵元素个数
+HUNGARIAN_MAX_SIZE = 4 * 1024 * 1024
+
+
+def assignTilesHungarian(target_avgs, input_avgs, max_uses):
+    """
+    用匈牙利算法求解替换图像的最优分配，使总平方距离最小
+
+    每个替换图像复制 max_uses 份作为分配对象，只适合小网格和小图像库。
+
+    @param {np.ndarray} target_avgs 形状为 (c, d) 的目标颜色值数组
+    @param {np.ndarray} input_avgs 形状为 (k, d) 的替换图像颜色值数组
+    @param {int} max_uses 每个替换图像最多使用的次数
+    @return {np.ndarray} 形状为 (c,) 的替换图像索引数组
+    """
+
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        raise ValueError('hungarian assignment requires scipy')
+    if len(target_avgs) * len(input_avgs) * max_uses > HUNGARIAN_MAX_SIZE:
+        raise ValueError('grid too large for hungarian assignment, '
+                         'use greedy instead')
+    cost = getSquaredDistances(target_avgs, input_avgs)
+    cost = np.repeat(cost, max_uses, axis=1)
+    rows, cols = linear_sum_assignment(cost)
+    indices = np.empty(len(target_avgs), dtype=np.intp)
+    indices[rows] = cols // max_uses
+    return indices
+
+
+@STATS.timed('match')
+def assignTiles(target_avgs, input_avgs, grid_size, max_uses=1,
+                min_distance=0, method='greedy', candidates=16,
+                color_index=None):
+    """
+    限制重复使用次数地为每个网格分配替换图像
+
+    greedy 为贪心算法：先为每个网格找出最近的若干个候选，按最佳距离从小到大依次处理网格，
+    每个网格取第一个仍可用的候选。替换图像用完后在可用标记里删除，候选都不可用时在剩余的
+    替换图像里查找。hungarian 用匈牙利算法求总距离最小的分配，只适合小网格。
+
+    @param {np.ndarray} target_avgs 形状为 (c, d) 的目标颜色值数组，按先行后列排列
+    @param {np.ndarray} input_avgs 形状为 (k, d) 的替换图像颜色值数组
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {int} max_uses 每个替换图像最多使用的次数，为 None 时不限制
+    @param {int} min_distance 同一个替换图像两次使用之间至少相隔的网格数（按行列距离的
+        较大者计算），为 0 时不限制
+    @param {str} method 分配算法，greedy 或 hungarian
+    @param {int} candidates greedy 算法为每个网格预先查找的候选个数
+    @param {cKDTree} color_index k-d 树索引，用于查找候选，为 None 时做矩阵运算
+    @return {np.ndarray} 形状为 (c,) 的替换图像索引数组
+    """
+
+    m, n = grid_size
+    ncells, ntiles = len(target_avgs), len(input_avgs)
+    if max_uses is not None and max_uses * ntiles < ncells:
+        raise ValueError('not enough input images: %d cells but %d images '
+                         'usable %d times each' % (ncells, ntiles, max_uses))
+    if method == 'hungarian':
+        if min_distance > 0:
+            raise ValueError('hungarian assignment does not support '
+                             'min_distance')
+        if max_uses is None:
+            max_uses = -(-ncells // ntiles)
+        return assignTilesHungarian(target_avgs, input_avgs, max_uses)
+    if method != 'greedy':
+        raise ValueError('unknown assignment method: %s' % (method,))
+
+    STATS.count('cells_matched', ncells)
+    candidate_indices = getNearestCandidates(target_avgs, input_avgs,
+                                             candidates, color_index)
+    # 先处理和最佳候选最接近的网格，让它们优先拿到最合适的替换图像
+    best = input_avgs[candidate_indices[:, 0]] - target_avgs
+    order = np.argsort((best * best).sum(axis=1), kind='stable')
+
+    uses = np.zeros(ntiles, dtype=np.int64)
+    available = np.ones(ntiles, dtype=bool)
+    # 每个替换图像已经放置的位置，用于检查重复使用的间隔
+    placed = {}
+    indices = np.empty(ncells, dtype=np.intp)
+
+    def allowed(tile, row, col):
+        for r, c in placed.get(tile, ()):
+            if max(abs(r - row), abs(c - col)) < min_distance:
+                return False
+        return True
+
+    for cell in order:
+        row, col = divmod(int(cell), n)
+        choice = -1
+        for tile in candidate_indices[cell]:
+            if available[tile] and (min_distance <= 0 or
+                                    allowed(tile, row, col)):
+                choice = tile
+                break
+        if choice < 0:
+            # 候选都不可用时，在剩余的替换图像里按距离从近到远查找
+            STATS.count('assign_fallbacks')
+            remaining = np.flatnonzero(available)
+            diff = input_avgs[remaining] - target_avgs[cell]
+            dist = (diff * diff).sum(axis=1)
+            if min_distance <= 0:
+                if len(remaining):
+                    choice = remaining[np.argmin(dist)]
+            else:
+                for i in np.argsort(dist, kind='stable'):
+                    if allowed(remaining[i], row, col):
+                        choice = remaining[i]
+                        break
+            if choice < 0:
+                raise ValueError('cannot place an image at cell (%d, %d) '
+                                 'with min_distance %d' % (row, col,
+                                                           min_distance))
+        indices[cell] = choice
+        uses[choice] += 1
+        if max_uses is not None and uses[choice] >= max_uses:
+            available[choice] = False
+        if min_distance > 0:
+            placed.setdefault(choice, []).append((row, col))
+    return indices
+
+
+def matchPhotomosaic(target_image, input_avgs, grid_size, backend='numpy',
+                     color_index=None, eps=0.0, max_uses=None, min_distance=0,
+                     assign='greedy', color_space='rgb', subgrid=1):
+    """
+    用批量匹配后端为目标图像的每个网格找到颜色最相似的替换图像
+
+    指定 max_uses 或 min_distance 时通过 assignTiles 限制替换图像的重复使用。默认按平均
+    RGB 值匹配；指定其他颜色空间或子网格时按 getGridFeatures 的特征匹配，这时 input_avgs
+    和 color_index 必须是用相同参数通过 getTileFeatureArray 算出的特征。
+
+    @param {Image} target_image 目标图像
+    @param {np.ndarray} input_avgs 形状为 (k, d) 的替换图像平均 RGB 值或特征
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {str} backend 匹配后端，numpy 或 kdtree
+    @param {cKDTree} color_index 预先建立好的 k-d 树索引，为 None 时现场建立
+    @param {float} eps kdtree 后端近似查找允许的相对误差
+    @param {int} max_uses 每个替换图像最多使用的次数，为 None 时不限制
+    @param {int} min_distance 同一个替换图像两次使用之间至少相隔的网格数
+    @param {str} assign 限制重复使用时的分配算法，greedy 或 hungarian
+    @param {str} color_space 颜色空间，rgb 或 lab
+    @param {int} subgrid 每个网格每行、每列划分的子网格个数
+    @return {np.ndarray} 按先行后列顺序排列的替换图像索引
+    """
+
+    # 直接在目标图像的 numpy 数组上算出所有网格的颜色平均值，不再切分小图像
+    print('averaging grid cells...')
+    target_avgs = getTargetFeatures(target_image, grid_size, color_space,
+                                    subgrid)
+
+    print('finding image matches...')
+    if max_uses is not None or min_distance > 0:
+        # 限制重复使用时，按分配算法依次为网格分配替换图像
+        if backend == 'kdtree' and color_index is None:
+            color_index = buildColorIndex(input_avgs)
+        match_indices = assignTiles(target_avgs, input_avgs, grid_size,
+                                    max_uses, min_distance, assign,
+                                    color_index=color_index)
+    else:
+        # 批量匹配：分块做矩阵运算或查询索引
+        match_indices = getMatchIndices(target_avgs, input_avgs, backend,
+                                        color_index, eps)
+    print('processed %d of %d...' % (len(target_avgs), len(target_avgs)))
+    return match_indices
+
+
+# createPhotomosaic 支持的匹配后端
+MATCH_BACKENDS = ('scan', 'numpy', 'kdtree')
+
+
 def createPhotomosaic(target_image, input_images, grid_size,
-                      reuse_images=True):
+                      reuse_images=True, backend='scan', color_index=None,
+                      eps=0.0, input_avgs=None, atlas=None, max_uses=None,
+                      min_distance=0, assign='greedy', color_space='rgb',
+                      subgrid=1):
     """
     图片马赛克生成
 
     @param {Image} target_image 目标图像
     @param {List[Image]} input_images 替换图像列表
     @param {Tuple[int, int]} grid_size 网格行数和列数
-    @param {bool} reuse_images 是否允许重复使用替换图像
+    @param {bool} reuse_images 是否允许重复使用替换图像，为 False 时相当于 max_uses=1
+    @param {str} backend 匹配后端，scan 为逐个扫描，numpy 为批量矩阵运算，kdtree 为
+        k-d 树索引查询
+    @param {cKDTree} color_index 预先建立好的 k-d 树索引，为 None 时现场建立
+    @param {float} eps kdtree 后端近似查找允许的相对误差，0 为精确查找
+    @param {np.ndarray} input_avgs 预先算好的替换图像平均 RGB 值，为 None 时现场计算
+    @param {Tuple[np.ndarray, np.ndarray]} atlas 预先用 stackTiles 堆叠好的替换图像，
+        为 None 时现场堆叠
+    @param {int} max_uses 每个替换图像最多使用的次数，为 None 时不限制
+    @param {int} min_distance 同一个替换图像两次使用之间至少相隔的网格数
+    @param {str} assign 限制重复使用时的分配算法，greedy 或 hungarian
+    @param {str} color_space 匹配使用的颜色空间，rgb 或 lab
+    @param {int} subgrid 每个网格每行、每列划分的子网格个数，大于 1 时按子网格的颜色分布
+        匹配
     @return {Image} 马赛克图像
     """
 
-    # 将目标图像切成网格小图像
-    print('splitting input image...')
-    target_images = splitImage(target_image, grid_size)
+    if backend not in MATCH_BACKENDS:
+        raise ValueError('unknown match backend: %s' % (backend,))
+    if backend == 'kdtree' and cKDTree is None:
+        print('scipy not installed, falling back to numpy backend')
+        backend = 'numpy'
+    if not reuse_images:
+        max_uses = 1
 
-    # 为每个网格小图像在替换图像列表里找到颜色最相似的替换图像
-    print('finding image matches...')
-    output_images = []
-    # 分 10 组进行，每组完成后打印进度信息，避免用户长时间等待
-    count = 0
-    batch_size = int(len(target_images) / 10)
+    features = color_space != 'rgb' or subgrid != 1
 
-    # 计算替换图像列表里每个图像的颜色平均值
-    avgs = []
-    for img in input_images:
-        avgs.append(getAverageRGB(img))
-
-    # 对每个网格小图像，从替换图像列表找到颜色最相似的那个，添加到 output_images 里
-    for img in target_images:
-        # 计算颜色平均值
-        avg = getAverageRGB(img)
-        # 找到最匹配的那个小图像，添加到 output_images 里
-        match_index = getBestMatchIndex(avg, avgs)
-        output_images.append(input_images[match_index])
-        # 如果完成了一组，打印进度信息
-        if count > 0 and batch_size > 10 and count % batch_size == 0:
-            print('processed %d of %d...' % (count, len(target_images)))
-        count += 1
-        # 如果不允许重用替换图像，则用过后就从列表里移除
-        if not reuse_images:
-            input_images.remove(match)
+    if backend != 'scan':
+        if features:
+            input_avgs = getTileFeatureArray(input_images, color_space,
+                                             subgrid)
+        elif input_avgs is None:
+            input_avgs = getAverageRGBArray(input_images)
+        match_indices = matchPhotomosaic(target_image, input_avgs, grid_size,
+                                         backend, color_index, eps, max_uses,
+                                         min_distance, assign, color_space,
+                                         subgrid)
+
+        # 从堆叠好的替换图像数组里直接拼接出大图像
+        print('creating mosaic...')
+        if atlas is None:
+            atlas = stackTiles(input_images)
+        return createImageGridArray(atlas[0], match_indices, grid_size,
+                                    atlas[1])
+    else:
+        if min_distance > 0 or max_uses not in (None, 1):
+            raise ValueError('scan backend only supports reuse_images')
+        if features:
+            raise ValueError('scan backend only supports rgb averages')
+        # 将目标图像切成网格小图像
+        print('splitting input image...')
+        target_images = splitImage(target_image, grid_size)
+        if max_uses == 1 and len(input_images) < len(target_images):
+            raise ValueError('not enough input images: %d cells but %d '
+                             'images' % (len(target_images),
+                                         len(input_images)))
+
+        # 为每个网格小图像在替换图像列表里找到颜色最相似的替换图像
+        print('finding image matches...')
+        output_images = []
+        # 分 10 组进行，每组完成后打印进度信息，避免用户长时间等待
+        count = 0
+        batch_size = int(len(target_images) / 10)
+
+        # 计算替换图像列表里每个图像的颜色平均值，复制一份列表，不允许重用时从副本里移除
+        input_images = list(input_images)
+        avgs = []
+        for img in input_images:
+            avgs.append(getAverageRGB(img))
+
+        # 对每个网格小图像，从替换图像列表找到颜色最相似的那个，添加到 output_images 里
+        for img in target_images:
+            # 计算颜色平均值
+            avg = getAverageRGB(img)
+            # 找到最匹配的那个小图像，添加到 output_images 里
+            match_index = getBestMatchIndex(avg, avgs)
+            output_images.append(input_images[match_index])
+            # 如果完成了一组，打印进度信息
+            if count > 0 and batch_size > 10 and count % batch_size == 0:
+                print('processed %d of %d...' % (count, len(target_images)))
+            count += 1
+            STATS.count('cells_matched')
+            # 如果不允许重用替换图像，则用过后就从列表里移除
+            if max_uses == 1:
+                del input_images[match_index]
+                del avgs[match_index]
 
     # 将 output_images 里的图像按网格大小拼接成一个大图像
     print('creating mosaic...')
@@ -214,56 +1586,772 @@ def createPhotomosaic(target_image, input_images, grid_size,
     return mosaic_image
 
 
-def main():
-    # 定义程序接收的命令行参数
-    parser = argparse.ArgumentParser(
-        description='Creates a photomosaic from input images')
-    parser.add_argument('--target-image', dest='target_image', required=True)
-    parser.add_argument('--input-folder', dest='input_folder', required=True)
-    parser.add_argument('--grid-size', nargs=2,
-                        dest='grid_size', required=True)
-    parser.add_argument('--output-file', dest='outfile', required=False)
+class MosaicLibrary:
+    """
+    常驻内存的替换图像库
+
+    替换图像的特征、k-d 树索引和堆叠好的图像数组只计算一次，之后可以为任意多张目标图像生成
+    马赛克，适合批量处理。
+    """
+
+    def __init__(self, images, avgs=None, backend='numpy', eps=0.0,
+                 color_space='rgb', subgrid=1):
+        if backend == 'scan':
+            backend = 'numpy'
+        self.images = images
+        self.backend = backend
+        self.eps = eps
+        self.color_space = color_space
+        self.subgrid = subgrid
+        if color_space != 'rgb' or subgrid != 1:
+            self.feats = getTileFeatureArray(images, color_space, subgrid)
+        elif avgs is None:
+            self.feats = getAverageRGBArray(images)
+        else:
+            self.feats = avgs
+        self.color_index = None
+        if backend == 'kdtree':
+            self.color_index = buildColorIndex(self.feats)
+        self.atlas, self.sizes = stackTiles(images)
+        # 自适应网格每一层缩小后的替换图像数组
+        self.level_atlases = {}
+
+    def match(self, target_image, grid_size, max_uses=None, min_distance=0,
+              assign='greedy'):
+        """
+        为目标图像的每个网格找到替换图像
+
+        @param {Image} target_image 目标图像
+        @param {Tuple[int, int]} grid_size 网格行数和列数
+        @param {int} max_uses 每个替换图像最多使用的次数，为 None 时不限制
+        @param {int} min_distance 同一个替换图像两次使用之间至少相隔的网格数
+        @param {str} assign 限制重复使用时的分配算法，greedy 或 hungarian
+        @return {np.ndarray} 按先行后列顺序排列的替换图像索引
+        """
+
+        return matchPhotomosaic(target_image, self.feats, grid_size,
+                                self.backend, self.color_index, self.eps,
+                                max_uses, min_distance, assign,
+                                self.color_space, self.subgrid)
+
+    def getLevelAtlas(self, depth, max_depth):
+        """
+        获取自适应网格第 depth 层使用的缩小后的替换图像数组
+
+        第 0 层使用裁剪为 2^max_depth 倍数大小的原图像数组，之后每层把上一层的宽高各缩小一半
+        （2 x 2 像素取平均），结果缓存起来供之后的目标图像复用。
+
+        @param {int} depth 层数
+        @param {int} max_depth 最大层数
+        @return {np.ndarray} 形状为 (k, h >> depth, w >> depth, 3) 的 uint8 数组
+        """
+
+        key = (depth, max_depth)
+        if key in self.level_atlases:
+            return self.level_atlases[key]
+        if depth == 0:
+            unit = 1 << max_depth
+            height = self.atlas.shape[1] // unit * unit
+            width = self.atlas.shape[2] // unit * unit
+            if width == 0 or height == 0:
+                raise ValueError('tiles are too small for depth %d' %
+                                 (max_depth,))
+            atlas = self.atlas[:, :height, :width]
+        else:
+            parent = self.getLevelAtlas(depth - 1, max_depth)
+            k, height, width, _ = parent.shape
+            blocks = parent.reshape(k, height // 2, 2, width // 2, 2, 3)
+            atlas = (blocks.mean(axis=(2, 4)) + 0.5).astype(np.uint8)
+        self.level_atlases[key] = atlas
+        return atlas
+
+    def renderAdaptive(self, target_image, grid_size, max_depth=2,
+                       threshold=20.0):
+        """
+        按四叉树自适应网格生成马赛克图像
+
+        每一层的叶子网格分别匹配替换图像，再用该层缩小后的替换图像填到输出图像里。
+
+        @param {Image} target_image 目标图像
+        @param {Tuple[int, int]} grid_size 第 0 层网格的行数和列数
+        @param {int} max_depth 最多细分的层数
+        @param {float} threshold 继续细分的颜色标准差阈值
+        @return {Tuple[Image, int]} 马赛克图像和网格总数
+        """
+
+        m, n = grid_size
+        print('splitting input image adaptively...')
+        with STATS.stage('grid_features'):
+            integral = IntegralImage(target_image, squares=True)
+            levels, (w, h) = splitQuadtree(target_image, grid_size, max_depth,
+                                           threshold, integral)
+        base = self.getLevelAtlas(0, max_depth)
+        th, tw = base.shape[1:3]
+        output = np.zeros((m * th, n * tw, 3), dtype=np.uint8)
+
+        print('finding image matches...')
+        count = 0
+        for depth, (rows, cols) in enumerate(levels):
+            if len(rows) == 0:
+                continue
+            level_size = (m << depth, n << depth)
+            # 叶子网格的特征直接从积分图查出，不需要重新遍历整层的像素
+            boxes = getGridBoxes(rows, cols, w >> depth, h >> depth)
+            if self.color_space == 'rgb' and self.subgrid == 1:
+                # 和 getTargetFeatures 一样使用整数平均 RGB 值
+                sums, weights = integral.getSums(boxes)
+                feats = sums // np.maximum(weights, 1)[:, None]
+            else:
+                feats = getBoxFeatures(integral, boxes, self.color_space,
+                                       self.subgrid)
+            indices = getMatchIndices(feats, self.feats, self.backend,
+                                      self.color_index, self.eps)
+            atlas = self.getLevelAtlas(depth, max_depth)
+            # 输出图像按该层网格切分的视图，直接写入叶子网格
+            view = output.reshape(level_size[0], th >> depth, level_size[1],
+                                  tw >> depth, 3)
+            view[rows, :, cols] = atlas[indices]
+            print('level %d: %d cells of %dx%d' % (depth, len(rows),
+                                                  tw >> depth, th >> depth))
+            count += len(rows)
+        return Image.fromarray(output), count
+
+    def render(self, target_image, grid_size, **kwargs):
+        """
+        生成目标图像的马赛克图像，参数同 match
+
+        @param {Image} target_image 目标图像
+        @param {Tuple[int, int]} grid_size 网格行数和列数
+        @return {Image} 马赛克图像
+        """
+
+        match_indices = self.match(target_image, grid_size, **kwargs)
+        return createImageGridArray(self.atlas, match_indices, grid_size,
+                                    self.sizes)
+
+
+# 批量处理进程里常驻的替换图像库，由 initBatchWorker 设置
+BATCH_LIBRARY = None
+
+
+def initBatchWorker(library):
+    """
+    批量处理进程的初始化函数，保存替换图像库供之后的任务使用
+
+    @param {MosaicLibrary} library 替换图像库
+    """
+
+    global BATCH_LIBRARY
+    BATCH_LIBRARY = library
+
+
+def renderBatchJob(job):
+    """
+    处理一个批量任务：读取目标图像，生成马赛克并保存
+
+    @param {Tuple[str, str, Tuple[int, int], dict, dict]} job 目标图像路径、输出路径、
+        网格行数和列数、传给 MosaicLibrary.render 的其他参数，以及传给 saveMosaic 的
+        fmt、quality、compress_level 编码参数
+    @return {Tuple[str, str, float]} 输出路径、错误信息（成功时为 None）和耗时秒数
+    """
+
+    target_path, output_path, grid_size, options, save_options = job
+    start = time.perf_counter()
+    try:
+        with Image.open(target_path) as target_image:
+            mosaic_image = BATCH_LIBRARY.render(target_image, grid_size,
+                                                **options)
+        saveMosaic(mosaic_image, output_path, **save_options)
+    except Exception as e:
+        return output_path, '%s: %s' % (target_path, e), 0.0
+    return output_path, None, time.perf_counter() - start
+
+
+def getBatchJobs(batch_dir=None, manifest=None, output_dir='.', fmt=None):
+    """
+    从目录或清单文件里读取批量任务
+
+    目录里的每个文件都是一张目标图像，输出到 output_dir 下的同名文件，扩展名由 fmt 决定，
+    默认为 PNG；清单文件每行是一个目标图像路径和输出路径，用制表符或空格分隔，# 开头的行会
+    被忽略。
+
+    @param {str} batch_dir 目标图像目录
+    @param {str} manifest 清单文件路径
+    @param {str} output_dir 目录模式下的输出目录
+    @param {str} fmt 目录模式下的输出格式
+    @return {List[Tuple[str, str]]} 目标图像路径和输出路径列表
+    """
+
+    jobs = []
+    if batch_dir:
+        ext = '.' + {'jpeg': 'jpg', 'tiff': 'tif'}.get(fmt, fmt or 'png')
+        for file in sorted(os.listdir(batch_dir)):
+            name = os.path.splitext(file)[0] + ext
+            jobs.append((os.path.join(batch_dir, file),
+                         os.path.join(output_dir, name)))
+    if manifest:
+        with open(manifest, encoding='utf-8') as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split('\t') if '\t' in line else line.split()
+                if len(parts) != 2:
+                    raise ValueError('invalid manifest line: %s' % (line,))
+                jobs.append((parts[0], parts[1]))
+    return jobs
+
+
+def runBatch(library, jobs, grid_size, workers=1, save_options=None,
+             **options):
+    """
+    用同一个替换图像库并行处理多个马赛克任务
+
+    进程池的每个进程在启动时拿到替换图像库（fork 方式下直接共享父进程内存），之后所有任务
+    都复用它，不再重新加载和建立索引。
+
+    @param {MosaicLibrary} library 替换图像库
+    @param {List[Tuple[str, str]]} jobs 目标图像路径和输出路径列表
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {int} workers 并行处理的进程数
+    @param {dict} save_options 传给 saveMosaic 的编码参数
+    @return {int} 失败的任务数
+    """
+
+    save_options = save_options or {}
+    tasks = [(target, output, grid_size, options, save_options)
+             for target, output in jobs]
+    failed = 0
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers, initBatchWorker, (library,))
+        results = pool.imap_unordered(renderBatchJob, tasks)
+    else:
+        initBatchWorker(library)
+        results = map(renderBatchJob, tasks)
+    try:
+        for output_path, error, seconds in results:
+            if error is not None:
+                failed += 1
+                print('failed %s' % (error,))
+            else:
+                print('saved output to %s (%.2fs)' % (output_path, seconds))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+
+def serveBatch(library, socket_path, grid_size, workers=1, save_options=None,
+               **options):
+    """
+    在本地 Unix socket 上常驻，逐行接收马赛克任务
+
+    每行是一个目标图像路径和输出路径，用制表符或空格分隔，处理完回复一行 "ok <输出路径>" 或
+    "error <错误信息>"。多个连接可以同时提交任务，由进程池并行处理。
+
+    @param {MosaicLibrary} library 替换图像库
+    @param {str} socket_path Unix socket 路径
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {int} workers 并行处理的进程数
+    @param {dict} save_options 传给 saveMosaic 的编码参数
+    """
+
+    save_options = save_options or {}
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initBatchWorker, (library,))
+    else:
+        initBatchWorker(library)
+
+    class BatchHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                parts = line.split('\t') if '\t' in line else line.split()
+                if len(parts) != 2:
+                    self.wfile.write(b'error expected: <target> <output>\n')
+                    continue
+                job = (parts[0], parts[1], grid_size, options, save_options)
+                if pool is not None:
+                    output_path, error, _ = pool.apply(renderBatchJob, (job,))
+                else:
+                    output_path, error, _ = renderBatchJob(job)
+                if error is not None:
+                    reply = 'error %s\n' % (error,)
+                else:
+                    reply = 'ok %s\n' % (output_path,)
+                self.wfile.write(reply.encode('utf-8'))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, BatchHandler)
+    print('batch worker listening on %s' % (socket_path,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('batch worker exit')
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    # 解析命令行参数
-    args = parser.parse_args()
+
+class MosaicSequence:
+    """
+    视频帧序列的马赛克生成
+
+    记录每个网格上次匹配时的颜色值和命中的替换图像，新的一帧只重新匹配颜色变化超过阈值的
+    网格，并且只重画这些网格，每帧的耗时和画面变化的多少成正比，而不是和网格总数成正比。与
+    上次匹配时（而不是上一帧）的颜色比较，缓慢的渐变累积超过阈值后同样会触发重新匹配。
+    """
+
+    def __init__(self, library, grid_size, threshold=8.0):
+        self.library = library
+        self.grid_size = grid_size
+        self.threshold = threshold
+        m, n = grid_size
+        # 所有帧使用相同的网格大小，画面不会因为命中的替换图像不同而抖动
+        height, width = library.atlas.shape[1:3]
+        self.frame = np.zeros((m, height, n, width, 3), dtype=np.uint8)
+        self.ref = None
+        self.indices = np.zeros(m * n, dtype=np.intp)
+
+    def update(self, frame_image):
+        """
+        处理一帧图像
+
+        @param {Image} frame_image 当前帧图像
+        @return {int} 重新匹配的网格数
+        """
+
+        library = self.library
+        m, n = self.grid_size
+        feats = getTargetFeatures(frame_image, self.grid_size,
+                                  library.color_space, library.subgrid)
+        STATS.count('frames')
+        if self.ref is None:
+            changed = np.arange(m * n)
+            self.ref = feats.copy()
+        else:
+            diff = np.abs(feats - self.ref).max(axis=1)
+            changed = np.flatnonzero(diff > self.threshold)
+        if len(changed) == 0:
+            return 0
+
+        self.ref[changed] = feats[changed]
+        self.indices[changed] = getMatchIndices(
+            feats[changed], library.feats, library.backend,
+            library.color_index, library.eps)
+        # 只重画重新匹配过的网格
+        height, width = self.frame.shape[1], self.frame.shape[3]
+        rows, cols = np.divmod(changed, n)
+        self.frame[rows, :, cols] = library.atlas[self.indices[changed],
+                                                  :height, :width]
+        return len(changed)
+
+    def toArray(self):
+        """
+        @return {np.ndarray} 当前马赛克帧，形状为 (H, W, 3) 的 uint8 数组
+        """
+
+        m, height, n, width, _ = self.frame.shape
+        return self.frame.reshape(m * height, n * width, 3)
+
+
+def iterFrames(source, frame_size=None):
+    """
+    依次读取视频帧
+
+    source 为目录时按文件名顺序读取其中的图像；为 - 时从标准输入读取原始 RGB24 帧（例如
+    ffmpeg -f rawvideo -pix_fmt rgb24 - 的输出），这时必须指定 frame_size。
+
+    @param {str} source 帧图像目录或 -
+    @param {Tuple[int, int]} frame_size 原始帧的宽度和高度
+    @return {Iterator[Image]} 帧图像
+    """
+
+    if source == '-':
+        if frame_size is None:
+            raise ValueError('frame size is required for raw frame input')
+        w, h = frame_size
+        nbytes = w * h * 3
+        stdin = sys.stdin.buffer
+        while True:
+            data = stdin.read(nbytes)
+            if len(data) < nbytes:
+                return
+            yield Image.frombuffer('RGB', (w, h), data, 'raw', 'RGB', 0, 1)
+    else:
+        for file in sorted(os.listdir(source)):
+            try:
+                with Image.open(os.path.join(source, file)) as im:
+                    im.load()
+            except Exception:
+                print("Invalid frame: %s" % (file,))
+                continue
+            yield im
+
+
+def runSequence(library, frames, grid_size, threshold, output):
+    """
+    为帧序列逐帧生成马赛克并输出
+
+    output 为 - 时把原始 RGB24 帧写到标准输出，可以直接交给 ffmpeg 编码；否则作为目录，
+    每帧保存为一个 PNG 文件。
+
+    @param {MosaicLibrary} library 替换图像库
+    @param {Iterator[Image]} frames 帧图像
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {float} threshold 网格颜色变化超过这个值时才重新匹配
+    @param {str} output 输出目录或 -
+    @return {int} 处理的帧数
+    """
+
+    sequence = MosaicSequence(library, grid_size, threshold)
+    # main 可能已经把 sys.stdout 换成了标准错误，这里直接使用原始的标准输出
+    stdout = sys.__stdout__.buffer if output == '-' else None
+    count = 0
+    for frame_image in frames:
+        start = time.perf_counter()
+        changed = sequence.update(frame_image)
+        pixels = sequence.toArray()
+        if stdout is not None:
+            stdout.write(pixels.data)
+        else:
+            Image.fromarray(pixels).save(
+                os.path.join(output, 'frame%06d.png' % (count,)))
+        print('frame %d: %d of %d cells changed (%.3fs)' % (
+            count, changed, len(sequence.indices),
+            time.perf_counter() - start), file=sys.stderr)
+        count += 1
+    if stdout is not None:
+        stdout.flush()
+    return count
+
+
+def writeStats(path):
+    """
+    把运行统计写为 JSON
+
+    @param {str} path 输出文件路径，为 - 时写到标准错误
+    """
+
+    report = json.dumps(STATS.toDict(), indent=2, sort_keys=True)
+    if path == '-':
+        print(report, file=sys.stderr)
+    else:
+        with open(path, 'w') as fp:
+            fp.write(report)
+        print('saved stats to %s' % (path,), file=sys.stderr)
+
+
+def runMain(parser, args):
+    """
+    按命令行参数生成马赛克
+
+    @param {argparse.ArgumentParser} parser 命令行参数解析器，用于报告参数错误
+    @param {argparse.Namespace} args 解析后的命令行参数
+    """
 
     # 网格大小
     grid_size = (int(args.grid_size[0]), int(args.grid_size[1]))
 
-    # 马赛克图像保存路径，默认为 mosaic.png
-    output_filename = 'mosaic.png'
+    # 马赛克图像保存路径，默认为 mosaic.png，逐行输出时默认为 mosaic.ppm
+    output_filename = 'mosaic.ppm' if args.tiled else 'mosaic.png'
     if args.outfile:
         output_filename = args.outfile
 
-    # 打开目标图像
-    print('reading targe image...')
-    target_image = Image.open(args.target_image)
+    batch = args.batch_dir or args.manifest or args.listen
+    if not batch and not args.frames and not args.target_image:
+        parser.error('--target-image is required without --batch-dir, '
+                     '--manifest, --listen or --frames')
+    if args.output_dir == '-':
+        # 标准输出用于写原始帧，提示信息改为输出到标准错误
+        sys.stdout = sys.stderr
+
+    if args.frames:
+        # 视频帧序列的替换图像缩放尺寸取第一帧的网格大小
+        frames = iterFrames(args.frames, args.frame_size)
+        if args.tile_size:
+            target_size = None
+        elif args.frame_size:
+            target_size = tuple(args.frame_size)
+        else:
+            first_frame = next(frames, None)
+            if first_frame is None:
+                parser.error('no frames found in %s' % (args.frames,))
+            target_size = first_frame.size
+            frames = itertools.chain([first_frame], frames)
+    elif batch:
+        # 批量模式下替换图像的缩放尺寸不依赖于某一张目标图像，需要指定或取第一个任务的
+        jobs = getBatchJobs(args.batch_dir, args.manifest, args.output_dir,
+                            args.format)
+        if args.tile_size:
+            target_size = None
+        elif jobs:
+            with Image.open(jobs[0][0]) as first_image:
+                target_size = first_image.size
+        else:
+            parser.error('--tile-size is required with --listen')
+    else:
+        # 打开目标图像
+        print('reading targe image...')
+        target_image = Image.open(args.target_image)
+        target_size = target_image.size
 
-    # 从指定文件夹下加载所有替换图像
+    # 从指定文件夹下加载所有替换图像，加载的同时缩放到指定的网格大小
     print('reading input images...')
-    input_images = getImages(args.input_folder)
+    if args.tile_size:
+        dims = tuple(args.tile_size)
+    else:
+        dims = (int(target_size[0] / grid_size[1]),
+                int(target_size[1] / grid_size[0]))
+    cache = TileCache(args.cache) if args.cache else None
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = int(args.max_memory * 1048576)
+    try:
+        input_images, input_avgs = loadTileLibrary(args.input_folder, dims,
+                                                   cache, args.workers,
+                                                   max_memory)
+    except MemoryError as e:
+        print('%s. Exiting.' % (e,))
+        exit()
+    finally:
+        if cache is not None:
+            cache.close()
     # 如果替换图像列表为空则退出程序
     if input_images == []:
         print('No input images found in %s. Exiting.' % (args.input_folder, ))
         exit()
 
-    # 将所有替换图像缩放到指定的网格大小
-    print('resizing images...')
-    dims = (int(target_image.size[0] / grid_size[1]),
-            int(target_image.size[1] / grid_size[0]))
-    for img in input_images:
-        img.thumbnail(dims)
+    if args.frames:
+        library = MosaicLibrary(input_images, input_avgs, args.backend,
+                                args.eps, args.color_space, args.subgrid)
+        if args.output_dir != '-' and not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        count = runSequence(library, frames, grid_size, args.threshold,
+                            args.output_dir)
+        print('processed %d frames.' % (count,))
+        print('done.')
+        return
+
+    if batch:
+        # 替换图像库只加载、索引一次，所有目标图像共用
+        library = MosaicLibrary(input_images, input_avgs, args.backend,
+                                args.eps, args.color_space, args.subgrid)
+        options = {
+            'max_uses': args.max_uses if args.reuse else 1,
+            'min_distance': args.min_distance,
+            'assign': args.assign,
+        }
+        save_options = {
+            'fmt': args.format,
+            'quality': args.quality,
+            'compress_level': args.compress_level,
+        }
+        if jobs:
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir)
+            print('processing %d targets...' % (len(jobs),))
+            failed = runBatch(library, jobs, grid_size, args.workers,
+                              save_options, **options)
+            print('%d of %d targets failed.' % (failed, len(jobs)))
+        if args.listen:
+            serveBatch(library, args.listen, grid_size, args.workers,
+                       save_options, **options)
+        print('done.')
+        return
 
-    # 生成马赛克图像
-    print('starting photomosaic creation...')
-    mosaic_image = createPhotomosaic(target_image, input_images, grid_size)
+    try:
+        if args.tiled:
+            # 逐行拼接并写入文件，不在内存里创建完整的马赛克图像
+            print('starting tiled photomosaic creation...')
+            backend = args.backend if args.backend != 'scan' else 'numpy'
+            max_uses = args.max_uses if args.reuse else 1
+            if args.color_space != 'rgb' or args.subgrid != 1:
+                input_avgs = getTileFeatureArray(input_images,
+                                                 args.color_space,
+                                                 args.subgrid)
+            match_indices = matchPhotomosaic(target_image, input_avgs,
+                                             grid_size, backend, eps=args.eps,
+                                             max_uses=max_uses,
+                                             min_distance=args.min_distance,
+                                             assign=args.assign,
+                                             color_space=args.color_space,
+                                             subgrid=args.subgrid)
+            atlas, sizes = stackTiles(input_images)
+            print('writing mosaic strips...')
+            ext = os.path.splitext(output_filename)[1].lower()
+            if ext in STRIP_FORMATS and not args.format:
+                W, H = writeImageGridStrips(atlas, match_indices, grid_size,
+                                            output_filename, sizes)
+                print("saved %dx%d output to %s" % (W, H, output_filename))
+            else:
+                # 其他格式按条带分别编码为多个文件，并行编码
+                start = time.perf_counter()
+                paths = writeImageGridStripFiles(
+                    atlas, match_indices, grid_size, output_filename, sizes,
+                    args.strip_rows, max(1, args.workers), args.format,
+                    args.quality, args.compress_level)
+                print("saved %d strips to %s ... %s (%.2fs)" % (
+                    len(paths), paths[0], paths[-1],
+                    time.perf_counter() - start))
+            print('done.')
+            return
+
+        if args.adaptive > 0:
+            # 四叉树自适应网格，细节多的区域使用更小的替换图像
+            print('starting adaptive photomosaic creation...')
+            library = MosaicLibrary(input_images, input_avgs, args.backend,
+                                    args.eps, args.color_space, args.subgrid)
+            mosaic_image, count = library.renderAdaptive(
+                target_image, grid_size, args.adaptive, args.split_threshold)
+            print('used %d cells instead of %d for a uniform grid' % (
+                count, (grid_size[0] * grid_size[1]) << (2 * args.adaptive)))
+        else:
+            # 生成马赛克图像
+            print('starting photomosaic creation...')
+            mosaic_image = createPhotomosaic(
+                target_image, input_images, grid_size,
+                reuse_images=args.reuse, backend=args.backend, eps=args.eps,
+                input_avgs=input_avgs, max_uses=args.max_uses,
+                min_distance=args.min_distance, assign=args.assign,
+                color_space=args.color_space, subgrid=args.subgrid)
+    except ValueError as e:
+        # 替换图像不够用等无法生成马赛克的情况
+        print('%s. Exiting.' % (e,))
+        exit()
 
     # 保存马赛克图像
-    mosaic_image.save(output_filename, 'PNG')
-    print("saved output to %s" % (output_filename,))
+    start = time.perf_counter()
+    saveMosaic(mosaic_image, output_filename, args.format, args.quality,
+               args.compress_level)
+    print("saved output to %s (encoded in %.2fs)" % (
+        output_filename, time.perf_counter() - start))
 
     print('done.')
 
 
+def main():
+    # 定义程序接收的命令行参数
+    parser = argparse.ArgumentParser(
+        description='Creates a photomosaic from input images')
+    parser.add_argument('--target-image', dest='target_image', required=False)
+    parser.add_argument('--input-folder', dest='input_folder', required=True)
+    parser.add_argument('--grid-size', nargs=2,
+                        dest='grid_size', required=True)
+    parser.add_argument('--output-file', dest='outfile', required=False)
+    parser.add_argument('--backend', dest='backend', default='numpy',
+                        choices=MATCH_BACKENDS)
+    parser.add_argument('--eps', dest='eps', type=float, default=0.0,
+                        help='approximation error bound for kdtree backend')
+    parser.add_argument('--color-space', dest='color_space', default='rgb',
+                        choices=COLOR_SPACES)
+    parser.add_argument('--subgrid', dest='subgrid', type=int, default=1,
+                        help='match on an N x N grid of averages per cell')
+    parser.add_argument('--no-reuse', dest='reuse', action='store_false',
+                        help='use each input image at most once')
+    parser.add_argument('--max-uses', dest='max_uses', type=int,
+                        required=False,
+                        help='maximum number of times an image is used')
+    parser.add_argument('--min-distance', dest='min_distance', type=int,
+                        default=0,
+                        help='minimum cell distance between repeats')
+    parser.add_argument('--assign', dest='assign', default='greedy',
+                        choices=('greedy', 'hungarian'))
+    parser.add_argument('--cache', dest='cache', required=False,
+                        help='SQLite file caching tile thumbnails and colors')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='number of processes decoding input images and '
+                             'running batch jobs')
+    parser.add_argument('--tile-size', nargs=2, dest='tile_size', type=int,
+                        required=False,
+                        help='tile width and height in the output, defaults '
+                             'to the target cell size')
+    parser.add_argument('--tiled', dest='tiled', action='store_true',
+                        help='render the output strip by strip to a .ppm, '
+                             '.raw or .npy file without holding it in memory')
+    parser.add_argument('--max-memory', dest='max_memory', type=float,
+                        required=False,
+                        help='memory limit in MB for tile thumbnails')
+    parser.add_argument('--format', dest='format', required=False,
+                        choices=sorted(OUTPUT_FORMATS),
+                        help='output format, defaults to the file extension '
+                             'or png')
+    parser.add_argument('--quality', dest='quality', type=int,
+                        required=False, help='jpeg/webp quality (1-100)')
+    parser.add_argument('--compress-level', dest='compress_level', type=int,
+                        required=False,
+                        help='png compression level (0-9, lower is faster)')
+    parser.add_argument('--strip-rows', dest='strip_rows', type=int,
+                        default=16,
+                        help='grid rows per file when --tiled writes '
+                             'encoded strips')
+    parser.add_argument('--adaptive', dest='adaptive', type=int, default=0,
+                        help='subdivide detailed cells up to this many '
+                             'quadtree levels')
+    parser.add_argument('--split-threshold', dest='split_threshold',
+                        type=float, default=20.0,
+                        help='color standard deviation that splits a cell '
+                             'in --adaptive mode')
+    parser.add_argument('--batch-dir', dest='batch_dir', required=False,
+                        help='create a mosaic for every image in this folder')
+    parser.add_argument('--manifest', dest='manifest', required=False,
+                        help='file listing "target output" pairs per line')
+    parser.add_argument('--listen', dest='listen', required=False,
+                        help='serve "target output" jobs on this Unix socket')
+    parser.add_argument('--output-dir', dest='output_dir', default='.',
+                        help='output folder for --batch-dir and --frames, '
+                             '"-" writes raw RGB24 frames to stdout')
+    parser.add_argument('--frames', dest='frames', required=False,
+                        help='folder of video frames, or "-" for raw RGB24 '
+                             'frames on stdin')
+    parser.add_argument('--frame-size', nargs=2, dest='frame_size', type=int,
+                        required=False,
+                        help='width and height of raw frames on stdin')
+    parser.add_argument('--threshold', dest='threshold', type=float,
+                        default=8.0,
+                        help='color change that triggers re-matching a cell '
+                             'in --frames mode')
+
+    parser.add_argument('--stats', dest='stats', required=False,
+                        help='write per-stage timings and counters as JSON '
+                             'to this file, "-" for stderr')
+    parser.add_argument('--profile', dest='profile', required=False,
+                        help='write cProfile stats to this file')
+    parser.add_argument('--trace-memory', dest='trace_memory',
+                        action='store_true',
+                        help='record allocated bytes per stage with '
+                             'tracemalloc (slow)')
+
+    # 解析命令行参数
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with STATS.stage('total'):
+            runMain(parser, args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print('saved profile to %s' % (args.profile,), file=sys.stderr)
+        if args.stats:
+            writeStats(args.stats)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,385 @@
+# coding:utf-8
+"""
+照片马赛克性能测试
+
+生成合成的替换图像库，测量 photomosaic.py 各阶段的耗时。
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import photomosaic
+
+
+def makeTileLibrary(imageDir, count, size, seed=0):
+    """
+    生成合成的替换图像库，每个图像是一种随机底色加上噪声的 JPEG
+
+    @param {str} imageDir 保存图像的目录
+    @param {int} count 图像个数
+    @param {Tuple[int, int]} size 图像的宽度和高度
+    @param {int} seed 随机数种子
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    for i in range(count):
+        base = rng.integers(0, 256, 3)
+        noise = rng.integers(-24, 24, (h, w, 3))
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(pixels).save(
+            os.path.join(imageDir, 'tile%06d.jpg' % (i,)), quality=90)
+
+
+def makeTargetImage(size, seed=0):
+    """
+    生成合成的目标图像：平滑的颜色渐变加上噪声
+
+    @param {Tuple[int, int]} size 图像的宽度和高度
+    @param {int} seed 随机数种子
+    @return {Image} 目标图像
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w]
+    pixels = np.stack([x * 255.0 / max(1, w - 1), y * 255.0 / max(1, h - 1),
+                       (x + y) * 127.5 / max(1, w + h - 2)], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def timeStage(results, name, items, func, *args, **kwargs):
+    """
+    执行一个阶段并记录耗时、吞吐量和内存峰值
+
+    @param {List[dict]} results 结果列表，记录追加到末尾
+    @param {str} name 阶段名称
+    @param {int} items 阶段处理的元素个数，用于计算吞吐量
+    @param {Callable} func 要执行的函数
+    @return 函数的返回值
+    """
+
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    results.append({
+        'stage': name,
+        'seconds': elapsed,
+        'items': items,
+        'items_per_second': items / elapsed if elapsed > 0 else None,
+        'peak_rss': photomosaic.getPeakRSS(),
+    })
+    return value
+
+
+# 测量的输出编码方式：名称、扩展名和传给 saveMosaic 的参数
+ENCODERS = [
+    ('png', '.png', {}),
+    ('png level 1', '.png', {'compress_level': 1}),
+    ('jpeg q90', '.jpg', {'quality': 90}),
+    ('webp q90', '.webp', {'quality': 90}),
+    ('tiff raw', '.tif', {}),
+]
+
+
+def benchStages(imageDir, target_image, grid_size, scan_cells, workers=1,
+                encode_workers=4):
+    """
+    依次测量照片马赛克各阶段的耗时
+
+    逐个扫描的 getBestMatchIndex 很慢，只测量前 scan_cells 个网格。
+
+    @param {str} imageDir 替换图像目录
+    @param {Image} target_image 目标图像
+    @param {Tuple[int, int]} grid_size 网格行数和列数
+    @param {int} scan_cells getBestMatchIndex 测量的网格个数
+    @param {int} workers loadTileLibrary 并行解码的进程数
+    @param {int} encode_workers 条带并行编码的线程数
+    @return {List[dict]} 每个阶段的测量结果
+    """
+
+    results = []
+    m, n = grid_size
+    cells = m * n
+    ntiles = len(os.listdir(imageDir))
+    dims = (int(target_image.size[0] / n), int(target_image.size[1] / m))
+
+    # 原有的加载方式：先加载全部原图，再缩放
+    images = timeStage(results, 'getImages', ntiles,
+                       photomosaic.getImages, imageDir)
+
+    def thumbnail(images):
+        for img in images:
+            img.thumbnail(dims)
+    timeStage(results, 'thumbnail', len(images), thumbnail, images)
+    del images
+
+    input_images, input_avgs = timeStage(
+        results, 'loadTileLibrary', ntiles, photomosaic.loadTileLibrary,
+        imageDir, dims, workers=workers)
+
+    # 网格切分和颜色平均值
+    target_images = timeStage(results, 'splitImage', cells,
+                              photomosaic.splitImage, target_image, grid_size)
+    target_avgs = timeStage(results, 'getAverageRGB', cells,
+                            lambda: [photomosaic.getAverageRGB(img)
+                                     for img in target_images])
+    timeStage(results, 'getAverageRGBNumpy', cells,
+              lambda: [photomosaic.getAverageRGBNumpy(img)
+                       for img in target_images])
+    grid_avgs = timeStage(results, 'getGridAverages', cells,
+                          photomosaic.getGridAverages, target_image,
+                          grid_size).reshape(-1, 3)
+    timeStage(results, 'getGridFeatures(lab, 2)', cells,
+              photomosaic.getGridFeatures, target_image, grid_size, 'lab', 2)
+    timeStage(results, 'getAverageRGBArray(tiles)', len(input_images),
+              photomosaic.getAverageRGBArray, input_images)
+
+    # 匹配
+    avgs = [tuple(avg) for avg in input_avgs]
+    sample = target_avgs[:scan_cells]
+    timeStage(results, 'getBestMatchIndex', len(sample),
+              lambda: [photomosaic.getBestMatchIndex(avg, avgs)
+                       for avg in sample])
+    match_indices = timeStage(results, 'getBestMatchIndices', cells,
+                              photomosaic.getBestMatchIndices, grid_avgs,
+                              input_avgs)
+    if photomosaic.cKDTree is not None:
+        color_index = timeStage(results, 'buildColorIndex', len(input_avgs),
+                                photomosaic.buildColorIndex, input_avgs)
+        timeStage(results, 'queryColorIndex', cells,
+                  photomosaic.queryColorIndex, color_index, grid_avgs)
+
+    # 拼接
+    output_images = [input_images[index] for index in match_indices]
+    timeStage(results, 'createImageGrid', cells,
+              photomosaic.createImageGrid, output_images, grid_size)
+    atlas, sizes = timeStage(results, 'stackTiles', len(input_images),
+                             photomosaic.stackTiles, input_images)
+    mosaic_image = timeStage(results, 'createImageGridArray', cells,
+                             photomosaic.createImageGridArray, atlas,
+                             match_indices, grid_size, sizes)
+
+    # 编码保存，和拼接分开计时，吞吐量按像素数计算
+    pixels = mosaic_image.size[0] * mosaic_image.size[1]
+    outdir = tempfile.mkdtemp(prefix='photomosaic-bench-out-')
+    try:
+        for name, ext, options in ENCODERS:
+            outfile = os.path.join(outdir, 'mosaic' + ext)
+            timeStage(results, 'encode(%s)' % (name,), pixels,
+                      photomosaic.saveMosaic, mosaic_image, outfile,
+                      **options)
+        timeStage(results, 'encode(png strips x%d)' % (encode_workers,),
+                  pixels, photomosaic.writeImageGridStripFiles, atlas,
+                  match_indices, grid_size, os.path.join(outdir, 'strip.png'),
+                  sizes, max(1, int(m / (encode_workers * 2))),
+                  encode_workers)
+    finally:
+        shutil.rmtree(outdir)
+    return results
+
+
+def printStages(results):
+    """
+    以表格形式打印各阶段的测量结果
+
+    @param {List[dict]} results benchStages 的测量结果
+    """
+
+    print('%-28s %10s %10s %14s %12s' % ('stage', 'seconds', 'items',
+                                         'items/s', 'peak RSS MB'))
+    for r in results:
+        rate = r['items_per_second']
+        peak = r['peak_rss']
+        print('%-28s %10.4f %10d %14s %12s' % (
+            r['stage'], r['seconds'], r['items'],
+            '%.1f' % (rate,) if rate is not None else '-',
+            '%.1f' % (peak / 1048576.0,) if peak is not None else '-'))
+
+
+def benchWorkers(imageDir, dims, workers_list):
+    """
+    测量不同进程数下加载替换图像库的耗时
+
+    @param {str} imageDir 替换图像目录
+    @param {Tuple[int, int]} dims 缩略图的最大宽度和高度
+    @param {List[int]} workers_list 要测试的进程数列表
+    """
+
+    base = None
+    for workers in workers_list:
+        start = time.perf_counter()
+        images, _ = photomosaic.loadTileLibrary(imageDir, dims,
+                                                workers=workers)
+        elapsed = time.perf_counter() - start
+        if base is None:
+            base = elapsed
+        print('workers=%-3d %8.3fs %8.1f images/s  speedup %.2fx' %
+              (workers, elapsed, len(images) / elapsed, base / elapsed))
+
+
+def benchAssign(cells, tiles, max_uses, min_distance, seed=0):
+    """
+    测量限制重复使用时不同分配方式的耗时
+
+    @param {int} cells 网格个数，网格按接近正方形排列
+    @param {int} tiles 替换图像个数
+    @param {int} max_uses 每个替换图像最多使用的次数
+    @param {int} min_distance 同一个替换图像两次使用之间至少相隔的网格数
+    @param {int} seed 随机数种子
+    """
+
+    rng = np.random.default_rng(seed)
+    m = int(np.sqrt(cells))
+    n = -(-cells // m)
+    target_avgs = rng.integers(0, 256, (m * n, 3))
+    input_avgs = rng.integers(0, 256, (tiles, 3))
+
+    runs = [('greedy/numpy', 'greedy', None)]
+    if photomosaic.cKDTree is not None:
+        runs.append(('greedy/kdtree', 'greedy',
+                     photomosaic.buildColorIndex(input_avgs)))
+    if (min_distance == 0 and m * n * tiles * max_uses <=
+            photomosaic.HUNGARIAN_MAX_SIZE):
+        runs.append(('hungarian', 'hungarian', None))
+    for name, method, color_index in runs:
+        start = time.perf_counter()
+        indices = photomosaic.assignTiles(target_avgs, input_avgs, (m, n),
+                                          max_uses, min_distance, method,
+                                          color_index=color_index)
+        elapsed = time.perf_counter() - start
+        diff = input_avgs[indices] - target_avgs
+        print('%-14s %8.3fs  %d cells  mean sq dist %.1f' %
+              (name, elapsed, m * n, (diff * diff).sum(axis=1).mean()))
+
+
+def mainWorkers(args):
+    workers_list = args.workers
+    if not workers_list:
+        # 默认从 1 开始按 2 的倍数测到 CPU 核数
+        workers_list = [1]
+        while workers_list[-1] * 2 <= os.cpu_count():
+            workers_list.append(workers_list[-1] * 2)
+
+    imageDir = tempfile.mkdtemp(prefix='photomosaic-bench-')
+    try:
+        print('generating %d tiles of %dx%d...' %
+              (args.tiles, args.tile_size[0], args.tile_size[1]))
+        makeTileLibrary(imageDir, args.tiles, args.tile_size)
+        benchWorkers(imageDir, tuple(args.thumb_size), workers_list)
+    finally:
+        shutil.rmtree(imageDir)
+
+
+def mainStages(args):
+    imageDir = tempfile.mkdtemp(prefix='photomosaic-bench-')
+    try:
+        print('generating %d tiles of %dx%d and a %dx%d target...' %
+              (args.tiles, args.tile_size[0], args.tile_size[1],
+               args.target_size[0], args.target_size[1]))
+        makeTileLibrary(imageDir, args.tiles, args.tile_size, args.seed)
+        target_image = makeTargetImage(args.target_size, args.seed)
+        results = benchStages(imageDir, target_image, tuple(args.grid_size),
+                              args.scan_cells, args.workers,
+                              args.encode_workers)
+    finally:
+        shutil.rmtree(imageDir)
+
+    printStages(results)
+    if args.json:
+        report = {
+            'config': {
+                'tiles': args.tiles,
+                'tile_size': list(args.tile_size),
+                'target_size': list(args.target_size),
+                'grid_size': list(args.grid_size),
+                'scan_cells': args.scan_cells,
+                'workers': args.workers,
+                'encode_workers': args.encode_workers,
+                'seed': args.seed,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'pillow': Image.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'stages': results,
+        }
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        print('saved results to %s' % (args.json,))
+
+
+def mainAssign(args):
+    print('assigning %d cells from %d tiles, max uses %d, min distance %d' %
+          (args.cells, args.tiles, args.max_uses, args.min_distance))
+    benchAssign(args.cells, args.tiles, args.max_uses, args.min_distance)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the photomosaic pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # 各阶段耗时
+    stages = subparsers.add_parser('stages', help='time each pipeline stage')
+    stages.add_argument('--tiles', dest='tiles', type=int, default=500)
+    stages.add_argument('--tile-size', nargs=2, dest='tile_size', type=int,
+                        default=(320, 240))
+    stages.add_argument('--target-size', nargs=2, dest='target_size',
+                        type=int, default=(2000, 1500))
+    stages.add_argument('--grid-size', nargs=2, dest='grid_size', type=int,
+                        default=(100, 100))
+    stages.add_argument('--scan-cells', dest='scan_cells', type=int,
+                        default=500,
+                        help='cells timed with the slow getBestMatchIndex')
+    stages.add_argument('--workers', dest='workers', type=int, default=1)
+    stages.add_argument('--encode-workers', dest='encode_workers', type=int,
+                        default=4,
+                        help='threads for the parallel strip encode stage')
+    stages.add_argument('--seed', dest='seed', type=int, default=0)
+    stages.add_argument('--json', dest='json', required=False,
+                        help='write results as JSON to this file')
+    stages.set_defaults(func=mainStages)
+
+    # 替换图像库并行加载
+    workers = subparsers.add_parser('workers',
+                                    help='tile library loading per worker '
+                                         'count')
+    workers.add_argument('--tiles', dest='tiles', type=int, default=500)
+    workers.add_argument('--tile-size', nargs=2, dest='tile_size', type=int,
+                         default=(1024, 768))
+    workers.add_argument('--thumb-size', nargs=2, dest='thumb_size',
+                         type=int, default=(32, 32))
+    workers.add_argument('--workers', nargs='+', dest='workers', type=int,
+                         default=None)
+    workers.set_defaults(func=mainWorkers)
+
+    # 限制重复使用的分配
+    assign = subparsers.add_parser('assign',
+                                   help='no-repeat / limited-repeat '
+                                        'assignment')
+    assign.add_argument('--cells', dest='cells', type=int, default=10000)
+    assign.add_argument('--tiles', dest='tiles', type=int, default=20000)
+    assign.add_argument('--max-uses', dest='max_uses', type=int, default=1)
+    assign.add_argument('--min-distance', dest='min_distance', type=int,
+                        default=0)
+    assign.set_defaults(func=mainAssign)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,209 +1,1170 @@
-import asynchat
-import asyncore
-
-
-# 定义端口
-PORT = 6666
-
-# 定义结束异常类
-class EndSession(Exception):
-    pass
-
-
-class ChatServer(asyncore.dispatcher):
-    """
-    聊天服务器
-    """
-
-    def __init__(self, port):
-        asyncore.dispatcher.__init__(self)
-        # 创建socket
-        self.create_socket()
-        # 设置 socket 为可重用
-        self.set_reuse_addr()
-        # 监听端口
-        self.bind(('', port))
-        self.listen(5)
-        self.users = {}
-        self.main_room = ChatRoom(self)
-
-    def handle_accept(self):
-        conn, addr = self.accept()
-        ChatSession(self, conn)
-
-#维护每个用户的连接会话，这里继承 asynchat 的 async_chat 类来实现
-class ChatSession(asynchat.async_chat):
-    """
-    负责和客户端通信
-    """
-
-    def __init__(self, server, sock):
-        asynchat.async_chat.__init__(self, sock)
-        self.server = server
-        self.set_terminator(b'\n')
-        self.data = []
-        self.name = None
-        self.enter(LoginRoom(server))
-
-    def enter(self, room):
-        # 从当前房间移除自身，然后添加到指定房间
-        try:
-            cur = self.room
-        except AttributeError:
-            pass
-        else:
-            cur.remove(self)
-        self.room = room
-        room.add(self)
-
-    def collect_incoming_data(self, data):
-        # 接收客户端的数据
-        self.data.append(data.decode("utf-8"))
-
-    def found_terminator(self):
-        # 当客户端的一条数据结束时的处理
-        line = ''.join(self.data)
-        self.data = []
-        try:
-            self.room.handle(self, line.encode("utf-8"))
-        # 退出聊天室的处理
-        except EndSession:
-            self.handle_close()
-
-    def handle_close(self):
-        # 当 session 关闭时，将进入 LogoutRoom
-        asynchat.async_chat.handle_close(self)
-        self.enter(LogoutRoom(self.server))
-
-#需要实现协议命令的相应方法，具体来说就是处理用户登录，退出，发消息，查询在线用户的代码
-class CommandHandler:
-    """
-    命令处理类
-    """
-
-    def unknown(self, session, cmd):
-        # 响应未知命令
-        # 通过 aynchat.async_chat.push 方法发送消息
-        session.push(('Unknown command {} \n'.format(cmd)).encode("utf-8"))
-
-    def handle(self, session, line):
-        line = line.decode()
-        # 命令处理
-        if not line.strip():
-            return
-        parts = line.split(' ', 1)
-        cmd = parts[0]
-        try:
-            line = parts[1].strip()
-        except IndexError:
-            line = ''
-        # 通过协议代码执行相应的方法
-        method = getattr(self, 'do_' + cmd, None)
-        try:
-            method(session, line)
-        except TypeError:
-            self.unknown(session, cmd)
-
-#用户刚登录时的房间、聊天的房间和退出登录的房间，这三种房间都继承自 CommandHandler
-class Room(CommandHandler):
-    """
-    包含多个用户的环境，负责基本的命令处理和广播
-    """
-
-    def __init__(self, server):
-        self.server = server
-        self.sessions = []
-
-    def add(self, session):
-        # 一个用户进入房间
-        self.sessions.append(session)
-
-    def remove(self, session):
-        # 一个用户离开房间
-        self.sessions.remove(session)
-
-    def broadcast(self, line):
-        # 向所有的用户发送指定消息
-        # 使用 asynchat.asyn_chat.push 方法发送数据
-        for session in self.sessions:
-            session.push(line)
-
-    def do_logout(self, session, line):
-        # 退出房间
-        raise EndSession
-
-
-class LoginRoom(Room):
-    """
-    处理登录用户
-    """
-
-    def add(self, session):
-        # 用户连接成功的回应
-        Room.add(self, session)
-        # 使用 asynchat.asyn_chat.push 方法发送数据
-        session.push(b'Connect Success')
-
-    def do_login(self, session, line):
-        # 用户登录逻辑
-        name = line.strip()
-        # 获取用户名称
-        if not name:
-            session.push(b'UserName Empty')
-        # 检查是否有同名用户
-        elif name in self.server.users:
-            session.push(b'UserName Exist')
-        # 用户名检查成功后，进入主聊天室
-        else:
-            session.name = name
-            session.enter(self.server.main_room)
-
-
-class LogoutRoom(Room):
-    """
-    处理退出用户
-    """
-
-    def add(self, session):
-        # 从服务器中移除
-        try:
-            del self.server.users[session.name]
-        except KeyError:
-            pass
-
-
-class ChatRoom(Room):
-    """
-    聊天用的房间
-    """
-
-    def add(self, session):
-        # 广播新用户进入
-        session.push(b'Login Success')
-        self.broadcast((session.name + ' has entered the room.\n').encode("utf-8"))
-        self.server.users[session.name] = session
-        Room.add(self, session)
-
-    def remove(self, session):
-        # 广播用户离开
-        Room.remove(self, session)
-        self.broadcast((session.name + ' has left the room.\n').encode("utf-8"))
-
-    def do_say(self, session, line):
-        # 客户端发送消息
-        self.broadcast((session.name + ': ' + line + '\n').encode("utf-8"))
-
-    def do_look(self, session, line):
-        # 查看在线用户
-        session.push(b'Online Users:\n')
-        for other in self.sessions:
-            session.push((other.name + '\n').encode("utf-8"))
-
-if __name__ == '__main__':
-
-    s = ChatServer(PORT)
-    try:
-        print("chat serve run at '0.0.0.0:{0}'".format(PORT))
-        asyncore.loop()
-    except KeyboardInterrupt:
-        print("chat server exit")
+import abc
+import argparse
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import urllib.parse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# uvloop 是可选的，安装后使用它的事件循环
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# 定义端口
+PORT = 6666
+# 等待 accept 的连接队列长度，大量客户端同时连接时太小会被拒绝
+BACKLOG = 4096
+# transport 写缓冲超过这个字节数时暂停写入，后续消息进入会话自己的队列
+WRITE_BUFFER = 64 * 1024
+# 每个会话暂停写入时最多排队的消息条数
+QUEUE_SIZE = 1024
+# 队列满时的处理策略：丢弃最旧的消息、断开慢客户端、把积压的消息合并为一条提示
+SLOW_POLICIES = ('drop-oldest', 'disconnect', 'coalesce')
+# 同一轮事件循环里发给一个会话的消息合并写出，最多积累这么多条就立即写出
+MAX_BATCH = 64
+# 一行命令的最大字节数，超过时断开连接，防止不换行的客户端占满内存
+MAX_LINE = 4096
+# 分页查看在线用户时每页的用户数
+ROSTER_PAGE = 100
+# 每个房间在内存里保留的最近消息条数，进入房间时回放
+HISTORY_SIZE = 50
+# history 命令一次最多返回的消息条数
+HISTORY_MAX = 1000
+# 历史日志文件名的最大字节数，大多数文件系统限制为 255
+LOG_NAME_MAX = 200
+
+# 进程间消息总线的消息头：消息类型、键（用户名或房间名）的长度、数据的长度
+BUS_HEADER = struct.Struct('!BHI')
+# 消息类型：申请用户名、同意、拒绝、释放用户名、其他进程的用户进入、离开、房间广播、
+# 需要记入历史的房间消息、房间用户数的变化
+(BUS_CLAIM, BUS_GRANT, BUS_DENY, BUS_RELEASE, BUS_JOINED, BUS_LEFT,
+ BUS_PUBLISH, BUS_MESSAGE, BUS_ROOM) = range(1, 10)
+# BUS_ROOM 消息的数据：用户数的增量
+BUS_COUNT = struct.Struct('!i')
+
+# 定义结束异常类
+class EndSession(Exception):
+    pass
+
+
+class ChatServer:
+    """
+    聊天服务器
+
+    基于 asyncio 的事件循环，每个连接只占用一个 ChatSession 对象，没有线程，
+    单个进程可以保持数万个空闲连接。
+    """
+
+    def __init__(self, port, host='', backlog=BACKLOG,
+                 write_buffer=WRITE_BUFFER, queue_size=QUEUE_SIZE,
+                 slow_policy='drop-oldest', reuse_port=False,
+                 roster_page=ROSTER_PAGE, flush_interval=0.0,
+                 max_batch=MAX_BATCH, max_line=MAX_LINE,
+                 history_size=HISTORY_SIZE, history_dir=None):
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError('unknown slow consumer policy: %s' % (slow_policy,))
+        self.port = port
+        self.host = host
+        self.backlog = backlog
+        self.write_buffer = write_buffer
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        # 多个工作进程用 SO_REUSEPORT 监听同一个端口，由内核分配连接
+        self.reuse_port = reuse_port
+        self.roster_page = roster_page
+        # 合并写出的间隔（秒），为 0 时在本轮事件循环结束时写出
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_line = max_line
+        # 房间消息历史的条数，以及保存历史日志文件的目录（为 None 时只保留在内存里）
+        self.history_size = history_size
+        self.history_dir = history_dir
+        # 用户名到会话、房间名到房间的索引
+        self.users = {}
+        self.rooms = {}
+        self.main_room = self.getRoom('main')
+        # 登录和退出的房间由所有会话共用
+        self.login_room = LoginRoom(self)
+        self.logout_room = LogoutRoom(self)
+        self.server = None
+        # 多进程模式下连接到消息总线的 BusClient，单进程时为 None
+        self.bus = None
+        # 暂停写入、正在排队的会话
+        self.paused = set()
+        # 有消息等待写出的会话，以及计划好的写出回调
+        self.dirty = []
+        self.flush_handle = None
+        self.sessions = 0
+        # 写出的消息条数和实际写入 transport 的次数，两者之差就是省下的 send 调用
+        self.messages = 0
+        self.writes = 0
+        self.counters = collections.Counter()
+
+    async def start(self):
+        # 创建监听 socket，每个新连接创建一个 ChatSession
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: ChatSession(self), self.host or None, self.port,
+            backlog=self.backlog, reuse_address=True,
+            reuse_port=self.reuse_port or None)
+        return self.server
+
+    def getRoom(self, name):
+        # 获取指定名称的聊天房间，不存在时创建
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = ChatRoom(self, name)
+        return room
+
+    def discardRoom(self, room):
+        # 所有工作进程上都没有用户的房间（主聊天室除外）删除，关闭它的日志文件
+        if room.sessions or room is self.main_room:
+            return
+        if self.bus is not None and room.name in self.bus.remote_rooms:
+            return
+        self.rooms.pop(room.name, None)
+        room.closeLog()
+
+    def scheduleFlush(self, session):
+        # 记录等待写出的会话，每轮事件循环（或每个写出间隔）只安排一次写出
+        self.dirty.append(session)
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.flush_interval > 0:
+                self.flush_handle = loop.call_later(self.flush_interval,
+                                                    self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        # 把所有会话积累的消息分别一次写出
+        self.flush_handle = None
+        dirty = self.dirty
+        self.dirty = []
+        for session in dirty:
+            session.flush()
+
+    def openLog(self, name):
+        # 打开房间的历史日志文件，没有配置目录或者打开失败时返回 None，房间只保留内存里的历史
+        if self.history_dir is None:
+            return None
+        filename = urllib.parse.quote(name, safe='')
+        if len(filename) + len('.log') > LOG_NAME_MAX:
+            # 转义后的房间名太长时截断，加上完整房间名的 sha1 区分
+            digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+            filename = '{}-{}'.format(
+                filename[:LOG_NAME_MAX - len(digest) - len('-.log')], digest)
+        try:
+            return MessageLog(os.path.join(self.history_dir, filename + '.log'))
+        except OSError as e:
+            print('cannot open history log for room {!r}: {}'.format(name, e),
+                  file=sys.stderr, flush=True)
+            return None
+
+    def close(self):
+        # 关闭所有房间的历史日志文件
+        for room in self.rooms.values():
+            room.closeLog()
+
+    def getQueueStats(self):
+        # 统计所有会话的出站队列深度，只需要遍历正在排队的会话
+        depths = [len(session.queue) for session in self.paused]
+        stats = {
+            'sessions': self.sessions,
+            'paused_sessions': len(depths),
+            'queued_messages': sum(depths),
+            'queued_bytes': sum(session.queued_bytes
+                                for session in self.paused),
+            'max_queue_depth': max(depths) if depths else 0,
+            'messages': self.messages,
+            'writes': self.writes,
+            'writes_saved': self.messages - self.writes,
+        }
+        stats.update(self.counters)
+        return stats
+
+    async def reportStats(self, interval):
+        # 定期把队列统计以 JSON 行输出到标准错误
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.getQueueStats()
+            stats['pid'] = os.getpid()
+            print(json.dumps(stats, sort_keys=True),
+                  file=sys.stderr, flush=True)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+#维护每个用户的连接会话，这里继承 asyncio.Protocol 来实现，由事件循环回调
+class ChatSession(asyncio.Protocol):
+    """
+    负责和客户端通信
+    """
+
+    # 每个连接一个会话，用 __slots__ 代替 __dict__ 减少每个会话占用的内存
+    __slots__ = ('server', 'data', 'name', 'transport', 'closed', 'queue',
+                 'queued_bytes', 'paused', 'dirty', 'skipped', 'room', 'rooms')
+
+    terminator = b'\n'
+
+    def __init__(self, server):
+        self.server = server
+        # 还没有收到换行符的不完整的一行
+        self.data = b''
+        self.name = None
+        # 当前处理命令的房间，以及加入的所有聊天房间（房间名到房间）
+        self.room = None
+        self.rooms = {}
+        self.transport = None
+        self.closed = False
+        # 还没有写出的消息，本轮事件循环结束时合并写出；暂停写入时继续积累，但有上限。
+        # 平时用占内存少的 list，暂停写入时换成 deque，见 pause_writing
+        self.queue = []
+        self.queued_bytes = 0
+        self.paused = False
+        # 是否已经安排了写出
+        self.dirty = False
+        # coalesce 策略下被合并掉的消息条数，恢复写入时作为一条提示发送
+        self.skipped = 0
+
+    def connection_made(self, transport):
+        # 连接建立后进入登录房间
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.write_buffer)
+        self.server.sessions += 1
+        self.enter(self.server.login_room)
+
+    def enter(self, room):
+        # 从当前房间移除自身，然后添加到指定房间
+        if self.room is not None:
+            self.room.remove(self)
+        self.room = room
+        room.add(self)
+
+    def push(self, data):
+        # 发送数据，先放进队列，同一轮事件循环里的多条消息合并为一次写出；
+        # 客户端读得慢、写缓冲超过上限时队列有上限，不让内存无限增长
+        if self.closed:
+            return
+        self.queue.append(data)
+        self.queued_bytes += len(data)
+        if self.paused:
+            if len(self.queue) > self.server.queue_size:
+                self.handle_overflow()
+        elif len(self.queue) >= self.server.max_batch:
+            self.flush()
+        elif not self.dirty:
+            self.dirty = True
+            self.server.scheduleFlush(self)
+
+    def flush(self):
+        # 把队列里的消息一次写出，暂停写入时等 resume_writing 再写
+        self.dirty = False
+        if self.paused or not self.queue:
+            return
+        data = self.queue
+        self.queue = []
+        self.queued_bytes = 0
+        # 连接已经出错断开时丢弃
+        if self.transport.is_closing():
+            return
+        self.server.messages += len(data)
+        self.server.writes += 1
+        if len(data) == 1:
+            self.transport.write(data[0])
+        else:
+            # 新版本的 asyncio 和 uvloop 用 sendmsg/writev 一次发出多个缓冲区
+            self.transport.writelines(data)
+
+    def handle_overflow(self):
+        # 队列满时按服务器配置的策略处理
+        policy = self.server.slow_policy
+        self.server.counters[policy.replace('-', '_')] += 1
+        if policy == 'disconnect':
+            # 正在广播时不能直接离开房间，先停止写入并断开连接，由 connection_lost 处理离开
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.transport.abort()
+        elif policy == 'drop-oldest':
+            self.queued_bytes -= len(self.queue.popleft())
+        else:
+            # 把积压的消息合并为一条提示，只保留最新的一条消息
+            latest = self.queue.pop()
+            self.skipped += len(self.queue)
+            self.queue.clear()
+            self.queue.append(latest)
+            self.queued_bytes = len(latest)
+
+    def pause_writing(self):
+        # transport 写缓冲超过上限，之后的消息留在队列里。队列可能积累到上限，换成 deque，
+        # drop-oldest 策略丢弃最旧的消息是 O(1) 的；空的 deque 比 list 大十几倍，只在这时使用
+        self.queue = collections.deque(self.queue)
+        self.paused = True
+        self.server.paused.add(self)
+        self.server.counters['pauses'] += 1
+
+    def resume_writing(self):
+        # 写缓冲降到下限以下，把队列里的消息一次写出
+        self.paused = False
+        self.server.paused.discard(self)
+        if self.skipped:
+            notice = '*** {} messages skipped ***\n'.format(self.skipped)
+            self.queue.appendleft(notice.encode("utf-8"))
+            self.skipped = 0
+        self.flush()
+
+    def data_received(self, data):
+        # 按换行符切分客户端的数据，一行可能分多次到达。整块数据一次 split，
+        # 不再逐行查找、复制剩余的数据
+        if self.data:
+            data = self.data + data
+        lines = data.split(self.terminator)
+        self.data = lines.pop()
+        max_line = self.server.max_line
+        for line in lines:
+            if self.closed:
+                return
+            if len(line) > max_line:
+                self.handle_long_line()
+                return
+            self.found_terminator(line)
+        # 先处理完整的行，再检查剩下的不完整的一行
+        if len(self.data) > max_line and not self.closed:
+            self.handle_long_line()
+
+    def found_terminator(self, line):
+        # 当客户端的一条数据结束时的处理
+        try:
+            self.room.handle(self, line)
+        # 退出聊天室的处理
+        except EndSession:
+            self.handle_close()
+
+    def handle_long_line(self):
+        # 一行超过长度上限，回应后断开连接
+        self.server.counters['long_lines'] += 1
+        self.data = b''
+        self.push(b'Line Too Long\n')
+        self.handle_close()
+
+    def handle_close(self):
+        # 当 session 关闭时，将进入 LogoutRoom
+        if self.room is self.server.logout_room:
+            return
+        # 先写出本轮还没有写出的消息
+        self.flush()
+        self.closed = True
+        self.server.sessions -= 1
+        self.paused = False
+        self.server.paused.discard(self)
+        self.queue = []
+        self.queued_bytes = 0
+        self.skipped = 0
+        self.transport.close()
+        self.enter(self.server.logout_room)
+
+    def connection_lost(self, exc):
+        # 客户端断开连接
+        self.handle_close()
+
+#需要实现协议命令的相应方法，具体来说就是处理用户登录，退出，发消息，查询在线用户的代码
+class CommandHandler:
+    """
+    命令处理类
+
+    每个子类定义时把 do_ 开头的方法整理成命令名（bytes）到方法的分发表，
+    处理每一行时直接在 bytes 上查表，不再拼接方法名和 getattr。
+    """
+
+    commands = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.commands = {name[3:].encode("utf-8"): getattr(cls, name)
+                        for name in dir(cls) if name.startswith('do_')}
+
+    def unknown(self, session, cmd):
+        # 响应未知命令
+        # 通过 ChatSession.push 方法发送消息
+        session.push(('Unknown command {} \n'.format(cmd)).encode("utf-8"))
+
+    def handle(self, session, line):
+        # 命令处理，命令名按 bytes 查分发表，参数只解码一次
+        if not line.strip():
+            return
+        cmd, _, line = line.partition(b' ')
+        method = self.commands.get(cmd)
+        if method is None:
+            self.unknown(session, cmd.decode("utf-8", errors="replace"))
+            return
+        # 通过协议代码执行相应的方法
+        method(self, session, line.strip().decode("utf-8", errors="replace"))
+
+#用户刚登录时的房间、聊天的房间和退出登录的房间，这三种房间都继承自 CommandHandler
+class Room(CommandHandler):
+    """
+    包含多个用户的环境，负责基本的命令处理和广播
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # 用 dict 作为有序集合，进入和离开都是 O(1)，同时保留进入的顺序
+        self.sessions = {}
+
+    def add(self, session):
+        # 一个用户进入房间
+        self.sessions[session] = None
+
+    def remove(self, session):
+        # 一个用户离开房间
+        del self.sessions[session]
+
+    def broadcast(self, line):
+        # 向所有的用户发送指定消息，line 只编码一次，所有会话共享同一个 bytes 对象
+        for session in self.sessions:
+            session.push(line)
+
+    def do_logout(self, session, line):
+        # 退出房间
+        raise EndSession
+
+
+class LoginRoom(Room):
+    """
+    处理登录用户
+    """
+
+    def add(self, session):
+        # 用户连接成功的回应
+        Room.add(self, session)
+        session.push(b'Connect Success')
+
+    def do_login(self, session, line):
+        # 用户登录逻辑
+        name = line.strip()
+        # 获取用户名称
+        if not name:
+            session.push(b'UserName Empty')
+        # 检查是否有同名用户
+        elif name in self.server.users:
+            session.push(b'UserName Exist')
+        # 多进程模式下用户名由消息总线统一分配，同意后再进入主聊天室
+        elif self.server.bus is not None:
+            self.server.bus.claim(name, session)
+        # 用户名检查成功后，进入主聊天室
+        else:
+            session.name = name
+            session.enter(self.server.main_room)
+
+
+class LogoutRoom(Room):
+    """
+    处理退出用户
+    """
+
+    def add(self, session):
+        # 离开其余加入的聊天房间
+        for room in list(session.rooms.values()):
+            room.remove(session)
+        # 从服务器中移除，同名的新会话不受影响
+        if self.server.users.get(session.name) is session:
+            del self.server.users[session.name]
+            if self.server.bus is not None:
+                self.server.bus.release(session.name)
+
+
+class ChatRoom(Room):
+    """
+    聊天用的房间
+
+    用户登录后进入主聊天室 main，之后可以用 join 加入其他房间并切换到该房间发言，
+    加入的所有房间的消息都会收到，主聊天室以外的消息带有 [房间名] 前缀。
+    """
+
+    def __init__(self, server, name='main'):
+        Room.__init__(self, server)
+        self.name = name
+        self.prefix = '' if name == 'main' else '[{}] '.format(name)
+        # 不带参数的 look 回应的缓存，用户进入或离开时失效，下一次 look 时重新拼接；
+        # 分页的 look 不使用它，只拼接请求的那一页
+        self.roster = None
+        # 最近消息的环形缓冲区，保存编码好的消息，满了自动丢弃最旧的
+        self.history = collections.deque(maxlen=server.history_size)
+        self.log = server.openLog(name)
+        if self.log is not None and server.history_size:
+            # 房间重新创建时从日志文件恢复最近的消息。消息里可能有 \r 等其他换行字符，
+            # 只按 \n 切分
+            lines = self.log.tail(server.history_size).split(b'\n')
+            self.history.extend(line + b'\n' for line in lines[:-1])
+
+    def add(self, session):
+        # 登录成功，进入主聊天室。先单独写出登录结果，再回放历史消息
+        session.push(b'Login Success')
+        session.flush()
+        self.server.users[session.name] = session
+        self.join(session)
+        self.replay(session)
+
+    def join(self, session):
+        # 广播新用户进入
+        self.broadcast((self.prefix + session.name + ' has entered the room.\n').encode("utf-8"))
+        Room.add(self, session)
+        # 用户名编码后的一行保存在 sessions 里，look 时不需要再逐个编码
+        self.sessions[session] = (session.name + '\n').encode("utf-8")
+        self.roster = None
+        session.rooms[self.name] = self
+        if self.server.bus is not None:
+            self.server.bus.count(self.name, 1)
+
+    def remove(self, session):
+        # 广播用户离开，没有用户的房间随之删除
+        Room.remove(self, session)
+        self.roster = None
+        del session.rooms[self.name]
+        if self.server.bus is not None:
+            self.server.bus.count(self.name, -1)
+        self.broadcast((self.prefix + session.name + ' has left the room.\n').encode("utf-8"))
+        self.server.discardRoom(self)
+
+    def broadcast(self, line, record=False):
+        # 多进程模式下同时发布到消息总线，由其他工作进程发给它们的用户
+        Room.broadcast(self, line)
+        if record:
+            self.record(line)
+        if self.server.bus is not None:
+            self.server.bus.publish(self.name, line, record)
+
+    def record(self, line):
+        # 把一条消息记入历史，同时追加到日志文件
+        self.history.append(line)
+        if self.log is not None:
+            self.log.append(line)
+
+    def getHistory(self, count):
+        """
+        获取最近的 count 条消息，内存里的不够时从日志文件读取
+
+        @param {int} count 消息条数
+        @return {bytes} 按时间顺序拼接好的消息
+        """
+
+        history = self.history
+        if count <= len(history):
+            return b''.join(itertools.islice(history, len(history) - count,
+                                             None))
+        if self.log is not None:
+            return self.log.tail(count)
+        return b''.join(history)
+
+    def replay(self, session):
+        # 把最近的消息一次发给刚进入房间的用户
+        if self.history:
+            session.push(b''.join(self.history))
+
+    def closeLog(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def do_say(self, session, line):
+        # 客户端发送消息
+        self.broadcast((self.prefix + session.name + ': ' + line + '\n').encode("utf-8"),
+                       record=True)
+
+    def do_history(self, session, line):
+        # 查看最近的消息：history [条数]
+        count = self.server.history_size
+        if line.isdigit():
+            count = int(line)
+        count = min(max(count, 1), HISTORY_MAX)
+        session.push(b'History:\n' + self.getHistory(count))
+
+    def do_join(self, session, line):
+        # 加入房间并切换到该房间，已经加入时只切换
+        name = line.strip()
+        if not name:
+            session.push(b'RoomName Empty\n')
+            return
+        room = self.server.getRoom(name)
+        joined = name not in session.rooms
+        if joined:
+            room.join(session)
+        session.room = room
+        session.push(('Joined {}\n'.format(name)).encode("utf-8"))
+        if joined:
+            room.replay(session)
+
+    def do_part(self, session, line):
+        # 离开房间，默认离开当前房间；主聊天室不能离开
+        name = line.strip() or self.name
+        room = session.rooms.get(name)
+        if room is None:
+            session.push(('Not In Room {}\n'.format(name)).encode("utf-8"))
+        elif room is self.server.main_room:
+            session.push(b'Cannot Part main\n')
+        else:
+            room.remove(session)
+            if session.room is room:
+                session.room = self.server.main_room
+            session.push(('Parted {}\n'.format(name)).encode("utf-8"))
+
+    def do_list(self, session, line):
+        # 列出所有房间和其中的用户数，多进程模式下包括其他工作进程上的房间和用户
+        remote = {}
+        if self.server.bus is not None:
+            remote = self.server.bus.remote_rooms
+        lines = ['Rooms:\n']
+        for name, room in self.server.rooms.items():
+            count = len(room.sessions) + remote.get(name, 0)
+            lines.append('{} {}\n'.format(name, count))
+        for name, count in remote.items():
+            if name not in self.server.rooms:
+                lines.append('{} {}\n'.format(name, count))
+        session.push(''.join(lines).encode("utf-8"))
+
+    def getUsers(self):
+        """
+        获取在线用户，返回按进入顺序排列的每个用户编码后的一行的视图列表，不复制数据
+
+        主聊天室还包括其他工作进程上的用户。
+        """
+
+        users = [self.sessions.values()]
+        if self.server.bus is not None and self is self.server.main_room:
+            users.append(self.server.bus.remote_users.values())
+        return users
+
+    def getRoster(self):
+        # 获取完整的 look 回应
+        if self.roster is None:
+            self.roster = b'Online Users:\n' + b''.join(
+                itertools.chain.from_iterable(self.getUsers()))
+        return self.roster
+
+    def do_look(self, session, line):
+        # 查看在线用户：look [页码] [用户名包含的文字]，不带参数时返回全部用户
+        args = line.split(None, 1)
+        if not args:
+            session.push(self.getRoster())
+            return
+        # 用户名可以包含空格，页码之后（没有页码时整行）都是要查找的文字
+        page = 1
+        needle = line.strip()
+        if args[0].isdigit():
+            page = max(int(args[0]), 1)
+            needle = args[1].strip() if len(args) > 1 else ''
+        size = self.server.roster_page
+        start = (page - 1) * size
+        users = self.getUsers()
+        if needle:
+            # 过滤时需要检查所有用户才知道总数，但只保留请求的那一页
+            needle = needle.encode("utf-8")
+            lines = []
+            count = 0
+            for other in itertools.chain.from_iterable(users):
+                if needle in other:
+                    if start <= count < start + size:
+                        lines.append(other)
+                    count += 1
+        else:
+            count = sum(len(view) for view in users)
+            lines = itertools.islice(itertools.chain.from_iterable(users),
+                                     start, start + size)
+        pages = max((count + size - 1) // size, 1)
+        header = 'Online Users (page {}/{}, {} users):\n'.format(
+            page, pages, count)
+        session.push(header.encode("utf-8") + b''.join(lines))
+
+
+class MessageLog:
+    """
+    房间消息的日志文件
+
+    只在末尾追加编码好的消息，每条消息以换行符结尾。读取最近的消息时用 mmap 映射文件，
+    从末尾向前查找换行符，不需要把整个文件读进内存，耗时只和读取的条数有关。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # 不使用缓冲，每条消息直接写到系统的页缓存，进程被杀掉也不会丢失
+        self.file = open(path, 'ab', buffering=0)
+
+    def append(self, line):
+        self.file.write(line)
+
+    def tail(self, count):
+        """
+        读取最后 count 条消息
+
+        @param {int} count 消息条数
+        @return {bytes} 按时间顺序拼接好的消息
+        """
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0 or count <= 0:
+            return b''
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+            # 最后一个字节是最后一条消息的换行符
+            start = size - 1
+            for _ in range(count):
+                start = data.rfind(b'\n', 0, start)
+                if start < 0:
+                    break
+            return data[start + 1:size]
+
+    def close(self):
+        self.file.close()
+
+
+#多进程模式下，工作进程之间通过一个 Unix socket 上的消息总线转发广播、统一分配用户名
+def addCount(counts, key, delta):
+    # 更新房间的用户数，没有用户的房间删除
+    count = counts.get(key, 0) + delta
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+
+class BusProtocol(asyncio.Protocol, abc.ABC):
+    """
+    消息总线两端共用的分帧逻辑，子类实现 message_received 处理收到的消息
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        # 一次收到的数据可能包含多条消息，也可能不足一条
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= BUS_HEADER.size:
+            kind, key_size, data_size = BUS_HEADER.unpack_from(self.buffer,
+                                                               offset)
+            start = offset + BUS_HEADER.size
+            end = start + key_size + data_size
+            if len(self.buffer) < end:
+                break
+            key = self.buffer[start:start + key_size].decode("utf-8")
+            self.message_received(kind, key,
+                                  bytes(self.buffer[start + key_size:end]))
+            offset = end
+        del self.buffer[:offset]
+
+    @abc.abstractmethod
+    def message_received(self, kind, key, data):
+        pass
+
+    @staticmethod
+    def pack(kind, key, data=b''):
+        key = key.encode("utf-8")
+        return BUS_HEADER.pack(kind, len(key), len(data)) + key + data
+
+    def send(self, kind, key, data=b''):
+        self.transport.write(self.pack(kind, key, data))
+
+
+class BusHub:
+    """
+    消息总线的中心，运行在主进程里，保存所有工作进程的用户名和每个房间的用户数
+    """
+
+    def __init__(self):
+        self.workers = set()
+        self.users = {}
+        # 房间名到所有工作进程上的用户数
+        self.rooms = {}
+
+    def count(self, room, delta):
+        addCount(self.rooms, room, delta)
+
+    def forward(self, sender, message):
+        # 转发给除了发送者以外的所有工作进程，消息只打包一次
+        for worker in self.workers:
+            if worker is not sender:
+                worker.transport.write(message)
+
+
+class BusHubConnection(BusProtocol):
+    """
+    消息总线中心和一个工作进程之间的连接
+    """
+
+    def __init__(self, hub):
+        BusProtocol.__init__(self)
+        self.hub = hub
+        self.names = set()
+        # 这个工作进程上每个房间的用户数，断开时从总数里减去
+        self.rooms = {}
+
+    def connection_made(self, transport):
+        BusProtocol.connection_made(self, transport)
+        self.hub.workers.add(self)
+        # 告诉新的工作进程已经在线的用户和每个房间的用户数
+        for name in self.hub.users:
+            self.send(BUS_JOINED, name)
+        for room, count in self.hub.rooms.items():
+            self.send(BUS_ROOM, room, BUS_COUNT.pack(count))
+
+    def message_received(self, kind, key, data):
+        hub = self.hub
+        if kind == BUS_CLAIM:
+            if key in hub.users:
+                self.send(BUS_DENY, key)
+            else:
+                hub.users[key] = self
+                self.names.add(key)
+                self.send(BUS_GRANT, key)
+                hub.forward(self, self.pack(BUS_JOINED, key))
+        elif kind == BUS_RELEASE:
+            self.release(key)
+        elif kind == BUS_PUBLISH or kind == BUS_MESSAGE:
+            hub.forward(self, self.pack(kind, key, data))
+        elif kind == BUS_ROOM:
+            self.count(key, BUS_COUNT.unpack(data)[0])
+
+    def count(self, room, delta):
+        # 记录这个工作进程上房间用户数的变化，转发给其他工作进程
+        addCount(self.rooms, room, delta)
+        self.hub.count(room, delta)
+        self.hub.forward(self, self.pack(BUS_ROOM, room, BUS_COUNT.pack(delta)))
+
+    def release(self, name):
+        if self.hub.users.get(name) is self:
+            del self.hub.users[name]
+            self.names.discard(name)
+            self.hub.forward(self, self.pack(BUS_LEFT, name))
+
+    def connection_lost(self, exc):
+        # 工作进程退出时释放它的所有用户名，它的用户离开所有房间
+        self.hub.workers.discard(self)
+        for name in list(self.names):
+            self.release(name)
+        for room, count in list(self.rooms.items()):
+            self.count(room, -count)
+
+
+class BusClient(BusProtocol):
+    """
+    工作进程连接到消息总线的一端
+    """
+
+    def __init__(self, server):
+        BusProtocol.__init__(self)
+        self.server = server
+        # 正在等待消息总线同意的用户名
+        self.pending = {}
+        # 其他工作进程上在线的用户名到编码后的一行，按进入的顺序排列
+        self.remote_users = {}
+        # 其他工作进程上的房间名到用户数
+        self.remote_rooms = {}
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def claim(self, name, session):
+        if name in self.pending:
+            session.push(b'UserName Exist')
+            return
+        self.pending[name] = session
+        self.send(BUS_CLAIM, name)
+
+    def release(self, name):
+        self.send(BUS_RELEASE, name)
+
+    def publish(self, room, line, record=False):
+        self.send(BUS_MESSAGE if record else BUS_PUBLISH, room, line)
+
+    def count(self, room, delta):
+        # 本进程的用户进入或离开房间
+        self.send(BUS_ROOM, room, BUS_COUNT.pack(delta))
+
+    def message_received(self, kind, key, data):
+        if kind == BUS_GRANT:
+            session = self.pending.pop(key, None)
+            # 等待期间断开了连接，用户名还给消息总线
+            if session is None or session.room is not self.server.login_room:
+                self.release(key)
+            else:
+                session.name = key
+                session.enter(self.server.main_room)
+        elif kind == BUS_DENY:
+            session = self.pending.pop(key, None)
+            if session is not None:
+                session.push(b'UserName Exist')
+        elif kind == BUS_JOINED:
+            self.remote_users[key] = (key + '\n').encode("utf-8")
+            self.server.main_room.roster = None
+        elif kind == BUS_LEFT:
+            self.remote_users.pop(key, None)
+            self.server.main_room.roster = None
+        elif kind == BUS_PUBLISH:
+            # 只发给本进程加入了该房间的用户，不再发布回消息总线
+            room = self.server.rooms.get(key)
+            if room is not None:
+                Room.broadcast(room, data)
+        elif kind == BUS_MESSAGE:
+            # 本进程没有用户的房间也要记入历史，之后进入房间的用户才能看到完整的历史，
+            # 各个工作进程的日志文件也都是完整的
+            room = self.server.getRoom(key)
+            Room.broadcast(room, data)
+            room.record(data)
+        elif kind == BUS_ROOM:
+            addCount(self.remote_rooms, key, BUS_COUNT.unpack(data)[0])
+            # 其他工作进程上的用户都离开了，本进程也没有用户时删除房间
+            room = self.server.rooms.get(key)
+            if room is not None and key not in self.remote_rooms:
+                self.server.discardRoom(room)
+
+    def connection_lost(self, exc):
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+
+def raiseFileLimit():
+    # 每个连接占用一个文件描述符，把软限制提高到硬限制，才能保持大量连接
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+async def run(server, stats_interval=None):
+    # 启动服务器，按需定期输出队列统计
+    if stats_interval:
+        asyncio.get_running_loop().create_task(
+            server.reportStats(stats_interval))
+    await server.serve_forever()
+
+
+async def runHub(sock, sentinels=()):
+    # 在主进程里运行消息总线的中心，任何一个工作进程退出时返回
+    hub = BusHub()
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def onExit():
+        if not exited.done():
+            exited.set_result(None)
+
+    for sentinel in sentinels:
+        loop.add_reader(sentinel, onExit)
+    server = await loop.create_unix_server(lambda: BusHubConnection(hub),
+                                           sock=sock)
+    async with server:
+        await exited
+
+
+async def runWorkerServer(server, bus_path, stats_interval=None, ready=None):
+    # 连接消息总线并监听端口后通知主进程，消息总线断开时退出
+    loop = asyncio.get_running_loop()
+    _, bus = await loop.create_unix_connection(lambda: BusClient(server),
+                                               bus_path)
+    server.bus = bus
+    await server.start()
+    if ready is not None:
+        ready.send(True)
+        ready.close()
+    task = loop.create_task(run(server, stats_interval))
+    await asyncio.wait([task, bus.lost], return_when=asyncio.FIRST_COMPLETED)
+    if task.done():
+        # 服务器出错时抛出异常，工作进程以非 0 状态退出
+        task.result()
+    task.cancel()
+
+
+def createServer(args, reuse_port=False, history_dir=None):
+    # 按命令行参数创建服务器
+    return ChatServer(args.port, args.host, args.backlog, args.write_buffer,
+                      args.queue_size, args.slow_policy, reuse_port=reuse_port,
+                      roster_page=args.roster_page,
+                      flush_interval=args.flush_interval,
+                      max_batch=args.max_batch, max_line=args.max_line,
+                      history_size=args.history, history_dir=history_dir)
+
+
+def runWorker(args, bus_path, index, ready):
+    # 工作进程的入口，ready 是通知主进程已经开始监听的管道
+    if args.uvloop and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    raiseFileLimit()
+    # 每个工作进程都收到全部房间消息，各自写自己的历史日志，避免多个进程追加同一个文件
+    history_dir = None
+    if args.history_dir:
+        history_dir = os.path.join(args.history_dir, 'worker%d' % (index,))
+        os.makedirs(history_dir, exist_ok=True)
+    s = createServer(args, reuse_port=True, history_dir=history_dir)
+    try:
+        asyncio.run(runWorkerServer(s, bus_path, args.stats_interval, ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+
+
+def runSharded(args):
+    # 启动消息总线和多个工作进程，工作进程共享同一个监听端口
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('--workers needs SO_REUSEPORT support')
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    # 先创建好监听的 Unix socket，工作进程启动后就能连接
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(bus_path)
+    sock.listen(args.workers)
+    workers = []
+    waiting = {}
+    for index in range(args.workers):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=runWorker,
+                                         args=(args, bus_path, index, writer),
+                                         daemon=True)
+        worker.start()
+        # 关闭主进程里的写端，工作进程退出时读端才会收到 EOF
+        writer.close()
+        workers.append(worker)
+        waiting[reader] = worker
+    try:
+        # 等所有工作进程都监听了端口再输出启动信息，有一个启动失败就退出
+        while waiting:
+            for reader in multiprocessing.connection.wait(list(waiting)):
+                worker = waiting.pop(reader)
+                try:
+                    reader.recv()
+                except EOFError:
+                    worker.join()
+                    raise SystemExit('chat server worker %s failed to start '
+                                     '(exit code %s)' % (worker.pid,
+                                                         worker.exitcode))
+                finally:
+                    reader.close()
+        # 立即输出，重定向到文件时外部也能据此判断所有工作进程都已监听端口
+        print("chat serve run at '{0}:{1}' with {2} workers".format(
+            args.host or '0.0.0.0', args.port, args.workers), flush=True)
+        asyncio.run(runHub(sock, [worker.sentinel for worker in workers]))
+        for worker in workers:
+            if worker.exitcode is not None:
+                raise SystemExit('chat server worker %s exited (exit code '
+                                 '%s)' % (worker.pid, worker.exitcode))
+    except KeyboardInterrupt:
+        print("chat server exit")
+    finally:
+        for worker in workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server.')
+    parser.add_argument('--host', dest='host', default='',
+                        help='address to listen on (default: all)')
+    parser.add_argument('--port', dest='port', type=int, default=PORT,
+                        help='port to listen on (default: %d)' % PORT)
+    parser.add_argument('--backlog', dest='backlog', type=int,
+                        default=BACKLOG,
+                        help='listen backlog (default: %d)' % BACKLOG)
+    parser.add_argument('--write-buffer', dest='write_buffer', type=int,
+                        default=WRITE_BUFFER,
+                        help='bytes buffered by a connection before its '
+                             'messages are queued (default: %d)' % WRITE_BUFFER)
+    parser.add_argument('--queue-size', dest='queue_size', type=int,
+                        default=QUEUE_SIZE,
+                        help='messages queued for a slow client before the '
+                             'slow policy applies (default: %d)' % QUEUE_SIZE)
+    parser.add_argument('--slow-policy', dest='slow_policy',
+                        choices=SLOW_POLICIES, default='drop-oldest',
+                        help='what to do when a slow client\'s queue is full')
+    parser.add_argument('--stats-interval', dest='stats_interval', type=float,
+                        help='print queue statistics as JSON lines to stderr '
+                             'every N seconds')
+    parser.add_argument('--flush-interval', dest='flush_interval',
+                        type=float, default=0.0,
+                        help='seconds to collect messages before writing '
+                             'them out; 0 writes at the end of each event '
+                             'loop iteration (default: 0)')
+    parser.add_argument('--max-batch', dest='max_batch', type=int,
+                        default=MAX_BATCH,
+                        help='messages collected for a connection before it '
+                             'is written out immediately (default: %d)'
+                             % MAX_BATCH)
+    parser.add_argument('--max-line', dest='max_line', type=int,
+                        default=MAX_LINE,
+                        help='longest accepted command line in bytes; longer '
+                             'lines disconnect the client (default: %d)'
+                             % MAX_LINE)
+    parser.add_argument('--roster-page', dest='roster_page', type=int,
+                        default=ROSTER_PAGE,
+                        help='users per page for a paged look '
+                             '(default: %d)' % ROSTER_PAGE)
+    parser.add_argument('--history', dest='history', type=int,
+                        default=HISTORY_SIZE,
+                        help='recent messages kept per room and replayed to '
+                             'users entering it; 0 disables (default: %d)'
+                             % HISTORY_SIZE)
+    parser.add_argument('--history-dir', dest='history_dir',
+                        help='also append room messages to log files in this '
+                             'directory, so history outlives the ring buffer '
+                             'and restarts')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='number of worker processes sharing the port; '
+                             'more than one starts a local message bus '
+                             '(default: 1)')
+    parser.add_argument('--no-uvloop', dest='uvloop', action='store_false',
+                        help='use the default asyncio event loop even if '
+                             'uvloop is installed')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        runSharded(args)
+        return
+    if args.uvloop and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    raiseFileLimit()
+    if args.history_dir:
+        os.makedirs(args.history_dir, exist_ok=True)
+    s = createServer(args, history_dir=args.history_dir)
+    try:
+        print("chat serve run at '{0}:{1}'".format(args.host or '0.0.0.0',
+                                                    args.port))
+        asyncio.run(run(s, args.stats_interval))
+    except KeyboardInterrupt:
+        print("chat server exit")
+    finally:
+        s.close()
+
+
+if __name__ == '__main__':
+    main()
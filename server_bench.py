@@ -0,0 +1,274 @@
+# coding:utf-8
+"""
+聊天服务器性能测试
+
+不经过网络，用假的 transport 直接把数据交给 ChatSession，测量 server.py 每秒能解析、
+分发多少行命令，以及广播时合并写出的效果。
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import time
+
+import server
+
+
+class FakeTransport:
+    """
+    只记录写入次数和字节数的 transport
+    """
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.closing = False
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def writelines(self, data):
+        self.writes += 1
+        self.bytes += sum(len(item) for item in data)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+    abort = close
+
+
+class BenchRoom(server.Room):
+    """
+    只计数的房间，用来单独测量分帧和命令分发
+    """
+
+    def __init__(self, chat_server):
+        server.Room.__init__(self, chat_server)
+        self.count = 0
+
+    def do_say(self, session, line):
+        self.count += 1
+
+
+class LegacyHandler:
+    """
+    改为 bytes 分帧之前的解析方式：逐段解码、拼接后重新编码，再解码一次，用 getattr 分发
+
+    原来逐段解码时切断的多字节字符会抛出 UnicodeDecodeError，这里用 replace 只是为了能比较速度。
+    """
+
+    def __init__(self):
+        self.data = []
+        self.count = 0
+
+    def feed(self, data):
+        while data:
+            index = data.find(b'\n')
+            if index < 0:
+                self.data.append(data.decode("utf-8", errors="replace"))
+                return
+            self.data.append(data[:index].decode("utf-8", errors="replace"))
+            data = data[index + 1:]
+            line = ''.join(self.data)
+            self.data = []
+            self.handle(line.encode("utf-8"))
+
+    def handle(self, line):
+        line = line.decode()
+        if not line.strip():
+            return
+        parts = line.split(' ', 1)
+        cmd = parts[0]
+        try:
+            line = parts[1].strip()
+        except IndexError:
+            line = ''
+        method = getattr(self, 'do_' + cmd, None)
+        try:
+            method(None, line)
+        except TypeError:
+            pass
+
+    def do_say(self, session, line):
+        self.count += 1
+
+
+def makePayload(lines, line_size):
+    """
+    生成测试用的 say 命令
+
+    @param {int} lines 行数
+    @param {int} line_size 每行消息的字节数
+    @return {bytes} 所有行拼接后的数据
+    """
+
+    text = ('hello 消息 ' * line_size).encode("utf-8")[:line_size]
+    # 不在多字节字符中间截断
+    text = text.decode("utf-8", errors="ignore").encode("utf-8")
+    line = b'say ' + text + b'\n'
+    return line * lines
+
+
+def getChunks(payload, chunk_size):
+    # 按固定大小切分数据，模拟每次 recv 收到的数据，会切断行和多字节字符
+    return [payload[i:i + chunk_size]
+            for i in range(0, len(payload), chunk_size)]
+
+
+def benchParse(lines, line_size, chunk_sizes, repeat=3):
+    """
+    测量分帧和命令分发的速度
+
+    @param {int} lines 行数
+    @param {int} line_size 每行消息的字节数
+    @param {List[int]} chunk_sizes 每次收到的数据大小
+    @param {int} repeat 重复次数，取最快的一次
+    @return {List[dict]} 每种数据大小、每种解析方式的结果
+    """
+
+    payload = makePayload(lines, line_size)
+    results = []
+    for chunk_size in chunk_sizes:
+        chunks = getChunks(payload, chunk_size)
+        for name in ('bytes', 'legacy'):
+            best = None
+            for _ in range(repeat):
+                if name == 'bytes':
+                    chat_server = server.ChatServer(0, max_line=line_size + 64)
+                    session = server.ChatSession(chat_server)
+                    session.transport = FakeTransport()
+                    session.room = room = BenchRoom(chat_server)
+                    feed = session.data_received
+                else:
+                    room = LegacyHandler()
+                    feed = room.feed
+                start = time.perf_counter()
+                for chunk in chunks:
+                    feed(chunk)
+                seconds = time.perf_counter() - start
+                assert room.count == lines, (name, room.count)
+                best = seconds if best is None else min(best, seconds)
+            results.append({'parser': name, 'chunk_size': chunk_size,
+                            'lines': lines, 'seconds': best,
+                            'lines_per_second': lines / best})
+    return results
+
+
+async def runBroadcast(lines, listeners, line_size):
+    chat_server = server.ChatServer(0)
+    sessions = []
+    for i in range(listeners + 1):
+        session = server.ChatSession(chat_server)
+        session.connection_made(FakeTransport())
+        session.data_received(b'login user%d\n' % (i,))
+        sessions.append(session)
+    await asyncio.sleep(0)
+    chat_server.messages = chat_server.writes = 0
+    sender = sessions[0]
+    payload = makePayload(lines, line_size)
+    # 每轮事件循环收到 16 行，和一次 recv 收到多条消息的情况相近
+    chunks = getChunks(payload, len(payload) // lines * 16)
+    start = time.perf_counter()
+    for chunk in chunks:
+        sender.data_received(chunk)
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    seconds = time.perf_counter() - start
+    return {'lines': lines, 'listeners': listeners, 'seconds': seconds,
+            'lines_per_second': lines / seconds,
+            'deliveries_per_second': lines * (listeners + 1) / seconds,
+            'messages': chat_server.messages, 'writes': chat_server.writes}
+
+
+def benchBroadcast(lines, listeners, line_size):
+    """
+    测量 say 广播到整个房间的速度和合并写出的次数
+
+    @param {int} lines 发送的行数
+    @param {int} listeners 房间里其他用户的个数
+    @param {int} line_size 每行消息的字节数
+    @return {dict} 结果
+    """
+
+    return asyncio.run(runBroadcast(lines, listeners, line_size))
+
+
+def getEnvironment():
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()}
+
+
+def writeJSON(path, config, results):
+    with open(path, 'w') as f:
+        config = dict((key, value) for key, value in config.items()
+                      if key != 'func')
+        json.dump({'config': config, 'environment': getEnvironment(),
+                   'results': results}, f, indent=2)
+
+
+def mainParse(args):
+    results = benchParse(args.lines, args.line_size, args.chunk_sizes)
+    print('%-8s %10s %12s %14s' % ('parser', 'chunk', 'seconds', 'lines/sec'))
+    for result in results:
+        print('%-8s %10d %12.4f %14.0f' % (result['parser'],
+                                           result['chunk_size'],
+                                           result['seconds'],
+                                           result['lines_per_second']))
+    if args.json:
+        writeJSON(args.json, vars(args), results)
+
+
+def mainBroadcast(args):
+    result = benchBroadcast(args.lines, args.listeners, args.line_size)
+    print('%d lines to %d sessions in %.4fs: %.0f lines/sec, %.0f '
+          'deliveries/sec' % (result['lines'], result['listeners'] + 1,
+                              result['seconds'], result['lines_per_second'],
+                              result['deliveries_per_second']))
+    print('%d messages in %d writes' % (result['messages'], result['writes']))
+    if args.json:
+        writeJSON(args.json, vars(args), [result])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server benchmarks.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # 分帧和命令分发
+    parse = subparsers.add_parser('parse',
+                                  help='lines/sec through framing and '
+                                       'command dispatch')
+    parse.add_argument('--lines', dest='lines', type=int, default=200000)
+    parse.add_argument('--line-size', dest='line_size', type=int, default=64)
+    parse.add_argument('--chunk-sizes', nargs='+', dest='chunk_sizes',
+                       type=int, default=[100, 4096, 65536])
+    parse.add_argument('--json', dest='json', required=False,
+                       help='write results as JSON to this file')
+    parse.set_defaults(func=mainParse)
+
+    # 房间广播
+    broadcast = subparsers.add_parser('broadcast',
+                                      help='say broadcast to a whole room')
+    broadcast.add_argument('--lines', dest='lines', type=int, default=2000)
+    broadcast.add_argument('--listeners', dest='listeners', type=int,
+                           default=1000)
+    broadcast.add_argument('--line-size', dest='line_size', type=int,
+                           default=64)
+    broadcast.add_argument('--json', dest='json', required=False,
+                           help='write results as JSON to this file')
+    broadcast.set_defaults(func=mainBroadcast)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()